@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""
+This module defines the archiving of finished run directories. A run directory
+is packed into a single zip archive, <run_directory>.zip, whose central directory
+is the index of its members: a member is read at random, without extracting the
+archive, and the readers of pyGWBSE open the members directly, e.g.
+
+    vasprun = LazyVasprun(find_file("/path/to/run.zip", "vasprun.xml"))
+
+archive_run_directories packs the run directories recorded in the result
+collections and points their run_directory at the archives.
+"""
+
+import os
+import shutil
+import time
+import zipfile
+
+from atomate.utils.utils import get_logger
+
+from pyGWBSE.compress import ARCHIVE_EXT, is_archive, is_compressed
+from pyGWBSE.database import RESULT_COLLECTIONS
+
+logger = get_logger(__name__)
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# files and directories that are not archived
+SKIP_FILES = [".pygwbse_cache"]
+
+
+def pack_run_directory(run_dir, archive=None, compresslevel=6, remove=False):
+    """
+    Pack run_dir into a zip archive. Files are deflated, except the files that
+    are already compressed (.gz, .zst, ...) which are stored as they are.
+    Symbolic links (e.g. files staged by link from a previous run) are not
+    archived. The archive is written to a temporary file and tested before it
+    replaces archive, and run_dir is only removed after that.
+
+    Args:
+        run_dir (str): run directory.
+        archive (str): path of the archive, default: run_dir + ".zip".
+        compresslevel (int): deflate level.
+        remove (bool): remove run_dir once it is archived.
+
+    Returns:
+        dict of the archive, number of members, size of the files and size of
+        the archive.
+    """
+    run_dir = os.path.abspath(run_dir)
+    archive = archive or run_dir.rstrip(os.sep) + ARCHIVE_EXT
+    tmp = archive + ".part"
+    start = time.time()
+    nbytes = 0
+    nfiles = 0
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True,
+                         compresslevel=compresslevel) as zf:
+        for root, dirs, files in os.walk(run_dir):
+            dirs[:] = sorted(d for d in dirs if d not in SKIP_FILES and not os.path.islink(os.path.join(root, d)))
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                if f in SKIP_FILES or os.path.islink(path):
+                    continue
+                compress_type = zipfile.ZIP_STORED if is_compressed(f) else zipfile.ZIP_DEFLATED
+                zf.write(path, os.path.relpath(path, run_dir), compress_type=compress_type)
+                nbytes += os.path.getsize(path)
+                nfiles += 1
+    with zipfile.ZipFile(tmp) as zf:
+        bad = zf.testzip()
+    if bad is not None:
+        os.remove(tmp)
+        raise IOError("Corrupted member {} in the archive of {}".format(bad, run_dir))
+    os.replace(tmp, archive)
+    if remove:
+        shutil.rmtree(run_dir)
+    logger.info("{}: {} files, {} bytes to {} bytes in {:.1f} s".format(
+        archive, nfiles, nbytes, os.path.getsize(archive), time.time() - start))
+    return {"archive": archive, "files": nfiles, "bytes": nbytes, "archive_bytes": os.path.getsize(archive)}
+
+
+def archive_run_directories(db, collections=None, query=None, remove=False, dry_run=False):
+    """
+    Pack the run directories of the documents of the result collections and
+    point their run_directory at the archives.
+
+    Args:
+        db: pymongo Database, e.g. VaspCalcDb.from_db_file(db_file).db.
+        collections ([str]): result collections, default: RESULT_COLLECTIONS.
+        query (dict): only the documents matching query, e.g.
+            {"material_id": "mp-149"}.
+        remove (bool): remove the run directories once they are archived.
+        dry_run (bool): only report the run directories that would be archived.
+
+    Returns:
+        [dict] of the archived run directories, see pack_run_directory.
+    """
+    collections = collections or RESULT_COLLECTIONS
+    run_dirs = set()
+    for coll in collections:
+        for run_dir in db[coll].distinct("run_directory", query or {}):
+            if run_dir and not is_archive(run_dir) and os.path.isdir(run_dir):
+                run_dirs.add(run_dir)
+    report = []
+    for run_dir in sorted(run_dirs):
+        if dry_run:
+            report.append({"run_directory": run_dir})
+            continue
+        stats = pack_run_directory(run_dir, remove=remove)
+        for coll in collections:
+            db[coll].update_many({"run_directory": run_dir}, {"$set": {"run_directory": stats["archive"]}})
+        report.append(dict(stats, run_directory=run_dir))
+    return report
@@ -0,0 +1,145 @@
+# coding: utf-8
+
+"""
+This module defines the binary storage of the large arrays of the results
+(quasi-particle and KS energies, projections, dielectric functions, ...). An
+array is stored as a compressed blob with its dtype and shape instead of a nested
+list:
+
+    {"@array": {"dtype": "<f4", "shape": [4, 8, 2], "codec": "shuffle-zlib"},
+     "data": Binary(...)}
+
+inline in the document when it is small, or in the "arrays" GridFS collection
+("fs_id" instead of "data") when it is large. unpack_arrays gives the arrays back
+as numpy arrays:
+
+    doc = unpack_arrays(db.QP_Results.find_one({"material_id": "mp-149"}), db)
+    doc["qp_energies"]["1"]    # ndarray (nkpt, nband, 2)
+"""
+
+import zlib
+
+import gridfs
+import numpy as np
+from bson import Binary
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# fields of the result documents stored as binary arrays
+ARRAY_FIELDS = ["qp_energies", "ks_energies", "dft_energies", "projected_eigs", "projected_eigs_reduced",
+                "frequency", "epsilon_1", "epsilon_2", "wannier_kpoints", "wannier_eigenvalues", "actual_kpoints",
+                "actual_eigenvalues"]
+
+# fields stored as binary arrays even without array storage, they are too large
+# for a document as nested lists
+BINARY_FIELDS = ["projected_eigs"]
+
+# marker of an encoded array
+ARRAY_KEY = "@array"
+
+# larger blobs (in bytes) are stored in GridFS
+INLINE_LIMIT = 1 << 20
+
+# GridFS collection of the large arrays
+GRIDFS_BUCKET = "arrays"
+
+
+def encode_array(array, dtype=None, level=6):
+    """
+    Encode a numeric array: the bytes of the array are shuffled (the i-th byte
+    of every element together, which makes floats much more compressible) and
+    compressed with zlib.
+
+    Args:
+        array (array-like): numeric array.
+        dtype (str): precision of the floating point arrays, e.g. "float32",
+            default: as they are.
+        level (int): zlib compression level.
+
+    Returns:
+        (metadata, compressed bytes)
+    """
+    array = np.asarray(array)
+    if dtype and array.dtype.kind == "f":
+        array = array.astype(dtype)
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    shuffled = array.view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+    meta = {"dtype": array.dtype.str, "shape": list(array.shape), "codec": "shuffle-zlib"}
+    return meta, zlib.compress(shuffled, level)
+
+
+def decode_array(meta, data):
+    """
+    Array of the metadata and the bytes of encode_array.
+    """
+    if meta["codec"] != "shuffle-zlib":
+        raise ValueError("Unknown array codec: {}".format(meta["codec"]))
+    dtype = np.dtype(meta["dtype"])
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    return raw.reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(meta["shape"])
+
+
+def pack_arrays(d, fields=None, dtype=None, inline_limit=INLINE_LIMIT, level=6):
+    """
+    Encode the numeric arrays of the fields of the document d (also the arrays of
+    a field that is a dict, e.g. {spin: array}); the values that are not
+    numeric arrays (ragged lists, strings, ...) are left as they are.
+
+    Args:
+        d (dict): document, after jsanitize.
+        fields ([str]): fields to encode, default: ARRAY_FIELDS.
+        dtype (str): precision of the floating point arrays, e.g. "float32".
+        inline_limit (int): larger blobs are stored in GridFS.
+        level (int): zlib compression level.
+
+    Returns:
+        (d, files): the files are the blobs to store in GridFS, {dotted path of
+        the "fs_id" field: (GridFS bucket, bytes, metadata)}, see
+        pyGWBSE.out2db.insert_result.
+    """
+    files = {}
+
+    def pack(value, path):
+        if isinstance(value, dict):
+            return {k: pack(v, "{}.{}".format(path, k)) for k, v in value.items()}
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            return value
+        if array.dtype.kind not in "biuf" or array.ndim == 0:
+            return value
+        meta, data = encode_array(array, dtype, level)
+        if len(data) <= inline_limit:
+            return {ARRAY_KEY: meta, "data": Binary(data)}
+        files[path + ".fs_id"] = (GRIDFS_BUCKET, data, meta)
+        return {ARRAY_KEY: meta, "fs_id": None}
+
+    d = dict(d)
+    for field in fields or ARRAY_FIELDS:
+        if d.get(field) is not None:
+            d[field] = pack(d[field], field)
+    return d, files
+
+
+def unpack_arrays(d, db=None):
+    """
+    Document d with its encoded arrays (see pack_arrays) decoded to numpy
+    arrays.
+
+    Args:
+        d (dict): document.
+        db: pymongo Database of the document, needed for the arrays stored in
+            GridFS.
+    """
+    if isinstance(d, list):
+        return [unpack_arrays(v, db) for v in d]
+    if not isinstance(d, dict):
+        return d
+    if ARRAY_KEY not in d:
+        return {k: unpack_arrays(v, db) for k, v in d.items()}
+    if "data" in d:
+        return decode_array(d[ARRAY_KEY], d["data"])
+    if db is None:
+        raise ValueError("The database is needed to read the arrays stored in GridFS")
+    return decode_array(d[ARRAY_KEY], gridfs.GridFS(db, GRIDFS_BUCKET).get(d["fs_id"]).read())
@@ -0,0 +1,215 @@
+# coding: utf-8
+
+"""
+This module defines an on-disk cache of parsed output files. The result of a
+reader is stored in a .npz file in a hidden directory next to the file it was read
+from; the arrays are stored as arrays and everything else as JSON. An entry is
+only used if the path, size and modification time of the file are unchanged, so
+the cache is invalidated automatically when the file is rewritten.
+
+The cache files are compressed, and a result whose arrays are larger than
+PYGWBSE_CACHE_MAX_MB (default: 64 MB uncompressed, e.g. the full projections of a
+large system) is not cached. The cache is off unless the environment variable
+PYGWBSE_CACHE=1 is set.
+"""
+
+import functools
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+from enum import Enum
+
+import numpy as np
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+CACHE_DIRNAME = ".pygwbse_cache"
+
+# bump when the format of the cache files or of a cached reader changes
+CACHE_VERSION = 2
+
+# results with more array data (in MB) are not cached, see PYGWBSE_CACHE_MAX_MB
+CACHE_MAX_MB = 64
+
+
+def cache_enabled():
+    """
+    True if the cache was switched on with PYGWBSE_CACHE=1.
+    """
+    return os.environ.get("PYGWBSE_CACHE", "0").lower() in ("1", "true", "yes", "on")
+
+
+def cache_max_bytes():
+    """
+    Largest size of the arrays of a cached result, PYGWBSE_CACHE_MAX_MB or
+    CACHE_MAX_MB.
+    """
+    try:
+        return float(os.environ.get("PYGWBSE_CACHE_MAX_MB", CACHE_MAX_MB)) * 1024 ** 2
+    except ValueError:
+        return CACHE_MAX_MB * 1024 ** 2
+
+
+def file_key(fname):
+    """
+    (absolute path, size, modification time in ns) of a file.
+    """
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+
+def cache_path(fname, tag, params=None):
+    """
+    Path of the cache file of fname for the reader tag called with params.
+    """
+    digest = hashlib.md5(repr(params).encode()).hexdigest()[:12]
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    return os.path.join(dirname, CACHE_DIRNAME, "{}.{}-{}.npz".format(basename, tag, digest))
+
+
+def cached_call(fname, tag, params, func):
+    """
+    Return the cached result of func() for the file fname, or call func and cache
+    its result. The cache is bypassed if it is disabled or fname is not a file.
+
+    Args:
+        fname (str): file read by func.
+        tag (str): name of the reader.
+        params: anything with a stable repr() that changes the result of func,
+            e.g. the arguments of the reader.
+        func (callable): function without arguments that reads fname.
+    """
+    if not cache_enabled() or not isinstance(fname, str) or not os.path.isfile(fname):
+        return func()
+    path = cache_path(fname, tag, params)
+    key = [CACHE_VERSION, file_key(fname), repr(params)]
+    found, value = load_cache(path, key)
+    if found:
+        return value
+    value = func()
+    save_cache(path, key, value)
+    return value
+
+
+def cached_reader(func):
+    """
+    Decorator caching a reader whose first argument is the file that it reads.
+    Other arguments that are existing files are part of the cache key as well.
+    """
+    @functools.wraps(func)
+    def wrapper(fname, *args, **kwargs):
+        params = [args, sorted(kwargs.items())]
+        params += [file_key(a) for a in args if isinstance(a, str) and os.path.isfile(a)]
+        return cached_call(fname, func.__name__, params, lambda: func(fname, *args, **kwargs))
+    return wrapper
+
+
+def load_cache(path, key):
+    """
+    (True, value) if path is a cache file written for key, (False, None) otherwise.
+    """
+    if not os.path.exists(path):
+        return False, None
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            if json.loads(str(npz["__key__"])) != key:
+                return False, None
+            return True, _unpack(json.loads(str(npz["__value__"])), npz)
+    except Exception:
+        # unreadable, truncated or from an older version of a reader
+        return False, None
+
+
+def save_cache(path, key, value):
+    """
+    Write value to the compressed cache file path. Nothing is written if value
+    can not be stored, its arrays are larger than cache_max_bytes() or the
+    directory is not writable.
+    """
+    arrays = {}
+    try:
+        packed = json.dumps(_pack(value, arrays))
+    except TypeError:
+        return
+    if sum(a.nbytes for a in arrays.values()) > cache_max_bytes():
+        return
+    arrays["__key__"] = np.array(json.dumps(key))
+    arrays["__value__"] = np.array(packed)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    finally:
+        # left behind by a failed write
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _pack(obj, arrays):
+    """
+    Convert obj to a JSON serializable structure, the arrays are moved to arrays.
+    """
+    if obj is None or (isinstance(obj, (bool, int, float, str)) and not isinstance(obj, Enum)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            raise TypeError("Can not cache object arrays")
+        name = "a{}".format(len(arrays))
+        arrays[name] = obj
+        return {"@array": name}
+    if isinstance(obj, Enum):
+        return {"@enum": _class_path(obj), "value": _pack(obj.value, arrays)}
+    if hasattr(obj, "as_dict") and hasattr(obj, "from_dict"):
+        d = obj.as_dict()
+        # attributes set after construction, e.g. Kpoints.genvec1, are not in as_dict
+        restored = vars(type(obj).from_dict(d)) if hasattr(obj, "__dict__") else {}
+        attrs = {k: v for k, v in getattr(obj, "__dict__", {}).items() if k not in restored}
+        return {"@object": _class_path(obj), "d": _pack(d, arrays), "attrs": _pack(attrs, arrays)}
+    if isinstance(obj, dict):
+        return {"@dict": [[_pack(k, arrays), _pack(v, arrays)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {"@tuple": [_pack(x, arrays) for x in obj]}
+    if isinstance(obj, list):
+        return [_pack(x, arrays) for x in obj]
+    raise TypeError("Can not cache objects of type {}".format(type(obj).__name__))
+
+
+def _unpack(obj, arrays):
+    """
+    Inverse of _pack.
+    """
+    if isinstance(obj, list):
+        return [_unpack(x, arrays) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if "@array" in obj:
+        return arrays[obj["@array"]]
+    if "@dict" in obj:
+        return {_unpack(k, arrays): _unpack(v, arrays) for k, v in obj["@dict"]}
+    if "@tuple" in obj:
+        return tuple(_unpack(x, arrays) for x in obj["@tuple"])
+    if "@enum" in obj:
+        return _load_class(obj["@enum"])(_unpack(obj["value"], arrays))
+    restored = _load_class(obj["@object"]).from_dict(_unpack(obj["d"], arrays))
+    for k, v in _unpack(obj["attrs"], arrays).items():
+        setattr(restored, k, v)
+    return restored
+
+
+def _class_path(obj):
+    return "{}:{}".format(type(obj).__module__, type(obj).__qualname__)
+
+
+def _load_class(path):
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
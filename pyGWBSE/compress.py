@@ -0,0 +1,234 @@
+# coding: utf-8
+
+"""
+This module defines the compression of the output files of a finished run and
+the transparent opening of compressed files. gzip, bz2 and xz files are handled
+by the standard library; zstd files need the optional zstandard package.
+
+The members of a run directory archive (see pyGWBSE.archive) are opened as if the
+archive were the directory, e.g. /path/to/run.zip/vasprun.xml.
+"""
+
+import bz2
+import fnmatch
+import gzip
+import io
+import lzma
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from monty.io import zopen as _zopen
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# extension of the compressed files for each method
+COMPRESSION_EXTS = {"gzip": ".gz", "zstd": ".zst"}
+
+# extensions of the files that can be read transparently
+COMPRESSED_EXTS = (".gz", ".bz2", ".xz", ".lzma", ".z", ".zst")
+
+# extension of the run directory archives
+ARCHIVE_EXT = ".zip"
+
+# large text outputs that are worth compressing once a run is finished
+OUTPUT_FILES = ["vasprun.xml", "OUTCAR", "LOCPOT", "EIGENVAL", "PROCAR", "DOSCAR", "wannier90_hr.dat",
+                "wannier90_band.dat", "wannier90_band.kpt", "wannier90_band.gnu"]
+
+
+def is_compressed(filename):
+    """
+    True if the file has the extension of a compressed file or is a member of
+    an archive, i.e. it can only be read as a stream.
+    """
+    return str(filename).lower().endswith(COMPRESSED_EXTS) or split_archive_path(filename)[0] is not None
+
+
+def split_archive_path(path):
+    """
+    (archive, member) if path is a member of an archive, e.g. run.zip/OUTCAR,
+    (None, None) otherwise.
+    """
+    path = str(path)
+    marker = ARCHIVE_EXT + os.sep
+    idx = path.lower().find(marker)
+    while idx >= 0:
+        archive = path[:idx + len(ARCHIVE_EXT)]
+        if os.path.isfile(archive):
+            return archive, path[idx + len(marker):].replace(os.sep, "/")
+        idx = path.lower().find(marker, idx + 1)
+    return None, None
+
+
+def is_archive(path):
+    """
+    True if path is a run directory archive.
+    """
+    return str(path).lower().endswith(ARCHIVE_EXT) and os.path.isfile(path)
+
+
+def archive_index(archive):
+    """
+    Index of the members of an archive, {name: (size, modification time in ns)},
+    read from its central directory (cached while the archive is unchanged).
+    """
+    st = os.stat(archive)
+    return _archive_index(os.path.abspath(archive), st.st_size, st.st_mtime_ns)
+
+
+@lru_cache(maxsize=64)
+def _archive_index(archive, size, mtime_ns):
+    with zipfile.ZipFile(archive) as zf:
+        return {info.filename: (info.file_size, int(time.mktime(info.date_time + (0, 0, -1)) * 1e9))
+                for info in zf.infolist() if not info.is_dir()}
+
+
+def scan_dir(directory):
+    """
+    Generate (name, modification time in ns) of the files of a directory or of
+    a run directory archive (or of a directory in it).
+    """
+    directory = str(directory or ".")
+    archive, prefix = (directory, "") if is_archive(directory) else split_archive_path(directory + os.sep)
+    if archive is None:
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                yield entry.name, entry.stat().st_mtime_ns
+        return
+    prefix = prefix.rstrip("/") + "/" if prefix.strip("/") else ""
+    for name, (size, mtime_ns) in archive_index(archive).items():
+        if name.startswith(prefix) and "/" not in name[len(prefix):]:
+            yield name[len(prefix):], mtime_ns
+
+
+def compression_ext(filename):
+    """
+    Extension of the compressed file filename (as in the name), "" if it is not
+    compressed.
+    """
+    ext = os.path.splitext(str(filename))[1]
+    return ext if ext.lower() in COMPRESSED_EXTS else ""
+
+
+def zopen(filename, mode="rt", **kwargs):
+    """
+    Open a plain or compressed file for reading, like monty's zopen with
+    support of zstd (.zst) files and of the members of archives in addition.
+    """
+    filename = str(filename)
+    archive, member = split_archive_path(filename)
+    if archive is None and not filename.lower().endswith(".zst"):
+        return _zopen(filename, mode, **kwargs)
+    if archive is not None:
+        with zipfile.ZipFile(archive) as zf:
+            # the member stays readable after the archive is closed
+            f = zf.open(member)
+        ext = compression_ext(member)
+        if ext:
+            f = decompress_stream(f, ext)
+    else:
+        f = decompress_stream(open(filename, "rb"), ".zst")
+    return f if "b" in mode else io.TextIOWrapper(f, **kwargs)
+
+
+def decompress_stream(fileobj, ext):
+    """
+    Binary file object with the decompressed content of fileobj, a file
+    compressed by the method of the extension ext.
+    """
+    ext = ext.lower()
+    if ext in (".gz", ".z"):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if ext == ".bz2":
+        return bz2.BZ2File(fileobj, mode="rb")
+    if ext in (".xz", ".lzma"):
+        return lzma.LZMAFile(fileobj, mode="rb")
+    if ext == ".zst":
+        if zstandard is None:
+            raise ImportError("the zstandard package is needed to read .zst files")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True))
+    raise ValueError("Unknown compression: {}".format(ext))
+
+
+def compress_file(fname, method="gzip", level=None, threads=0, chunk_size=1 << 20):
+    """
+    Compress fname to fname.gz (or .zst) and remove fname. The compressed file
+    is written to a temporary file first and keeps the modification time of
+    fname, so an interrupted compression leaves fname untouched.
+
+    Args:
+        fname (str): file to compress.
+        method (str): "gzip" or "zstd".
+        level (int): compression level, default: 6 for gzip and 3 for zstd.
+        threads (int): number of threads of zstd, -1 for one per core.
+        chunk_size (int): number of bytes compressed at a time.
+
+    Returns:
+        path of the compressed file.
+    """
+    if method not in COMPRESSION_EXTS:
+        raise ValueError("Unknown compression method: {}".format(method))
+    dest = fname + COMPRESSION_EXTS[method]
+    tmp = dest + ".part"
+    with open(fname, "rb") as f_in, open(tmp, "wb") as raw:
+        if method == "gzip":
+            f_out = gzip.GzipFile(os.path.basename(fname), "wb", 6 if level is None else level, raw,
+                                  os.stat(fname).st_mtime)
+        else:
+            if zstandard is None:
+                raise ImportError("the zstandard package is needed for zstd compression")
+            cctx = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+            f_out = cctx.stream_writer(raw, size=os.fstat(f_in.fileno()).st_size, closefd=False)
+        with f_out:
+            shutil.copyfileobj(f_in, f_out, chunk_size)
+    shutil.copystat(fname, tmp)
+    os.replace(tmp, dest)
+    os.remove(fname)
+    return dest
+
+
+def compress_outputs(directory=".", patterns=None, method="gzip", level=None, workers=4, min_size=1 << 20):
+    """
+    Compress the output files of directory in parallel, one file per thread
+    (zlib and zstd release the GIL); zstd also uses several threads per file.
+    Compressed files, links and files smaller than min_size are skipped.
+
+    Args:
+        directory (str): run directory.
+        patterns ([str]): fnmatch patterns of the files to compress, default:
+            OUTPUT_FILES and their .relax* versions.
+        method (str): "gzip" or "zstd".
+        level (int): compression level.
+        workers (int): number of files compressed at the same time.
+        min_size (int): smaller files are not compressed.
+
+    Returns:
+        [dict] of the file, its size before and after compression and the time
+        of the compression.
+    """
+    patterns = patterns or OUTPUT_FILES + [f + ".relax*" for f in OUTPUT_FILES]
+    fnames = []
+    for entry in os.scandir(directory):
+        if not entry.is_file(follow_symlinks=False) or is_compressed(entry.name) or entry.name.endswith(".part"):
+            continue
+        if entry.stat().st_size >= min_size and any(fnmatch.fnmatch(entry.name, p) for p in patterns):
+            fnames.append(entry.path)
+
+    def compress(fname):
+        start = time.time()
+        nbytes = os.path.getsize(fname)
+        dest = compress_file(fname, method, level, threads=-1 if method == "zstd" else 0)
+        return {"file": os.path.basename(fname), "method": method, "bytes": nbytes,
+                "compressed_bytes": os.path.getsize(dest), "time": time.time() - start}
+
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(fnames)), 1)) as executor:
+        return list(executor.map(compress, sorted(fnames)))
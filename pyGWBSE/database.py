@@ -0,0 +1,214 @@
+# coding: utf-8
+
+"""
+This module defines the database handle shared by the pyGWBSE tasks. The handle
+of a db_file is created on first use and reused by every task of the process;
+MongoClient keeps a pool of connections, so the client creation, authentication
+and connection handshake are paid once per process instead of once per insert.
+
+It also defines the structured query fields of the result documents (stage and
+iteration of the task label, GW parameters, workflow id), their indexes and the
+natural key on which a rerun replaces its previous document.
+"""
+
+import os
+import re
+import threading
+import time
+
+from atomate.utils.utils import get_logger
+from atomate.vasp.database import VaspCalcDb
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = get_logger(__name__)
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# seconds between two health checks (ping) of a pooled handle
+HEALTH_CHECK_INTERVAL = 60
+
+# collections of the results written by pyGWBSE.out2db
+RESULT_COLLECTIONS = ["QP_Results", "BSE_Results", "RPA_Results", "EMC_Results", "EPS_Results", "WANNIER_Results"]
+
+# fields of the compound index of the result collections
+INDEX_FIELDS = ["material_id", "stage", "job_tag", "ifconv", "iteration"]
+
+# fields that identify a result document, a rerun (or a new workflow) of the
+# same material replaces its document; the fields that do not apply are empty
+# (e.g. the iteration of a BSE run, ifconv outside the GW runs)
+NATURAL_KEY = ["material_id", "stage", "job_tag", "ifconv", "iteration"]
+
+# fields of the natural key without which a document is always inserted
+REQUIRED_KEY = ["material_id"]
+
+# INCAR parameters of the GW convergence, stored in gw_params
+GW_PARAMS = ["NBANDS", "ENCUTGW", "NOMEGA"]
+
+_pool = {}
+_lock = threading.Lock()
+_indexed = set()
+
+
+def get_db(db_file, admin=True):
+    """
+    Shared VaspCalcDb of db_file for this process. The handle is pinged when it
+    was not checked for HEALTH_CHECK_INTERVAL seconds and reconnected if the ping
+    fails or db_file was modified; a forked process gets its own handle.
+
+    Args:
+        db_file (str): path to the file containing the credentials.
+        admin (bool): whether to use the admin user.
+
+    Returns:
+        VaspCalcDb
+    """
+    key = (os.path.abspath(db_file), admin)
+    mtime = os.stat(db_file).st_mtime_ns
+    with _lock:
+        entry = _pool.get(key)
+        if entry is not None and (entry["pid"] != os.getpid() or entry["mtime"] != mtime):
+            _close(_pool.pop(key), fork=entry["pid"] != os.getpid())
+            entry = None
+        if entry is not None and time.time() - entry["checked"] > HEALTH_CHECK_INTERVAL:
+            try:
+                entry["mmdb"].connection.admin.command("ping")
+                entry["checked"] = time.time()
+            except PyMongoError as exc:
+                logger.warning("Reconnecting to the database of {}: {}".format(db_file, exc))
+                _close(_pool.pop(key))
+                entry = None
+        if entry is None:
+            entry = {"mmdb": VaspCalcDb.from_db_file(db_file, admin=admin), "pid": os.getpid(),
+                     "mtime": mtime, "checked": time.time()}
+            _pool[key] = entry
+        return entry["mmdb"]
+
+
+def close_all():
+    """
+    Close the handles of the pool.
+    """
+    with _lock:
+        while _pool:
+            _close(_pool.popitem()[1])
+
+
+def _close(entry, fork=False):
+    # the sockets of a forked process belong to its parent, they are just dropped
+    if fork:
+        return
+    try:
+        entry["mmdb"].connection.close()
+    except PyMongoError:
+        pass
+
+
+def set_field(d, path, value):
+    """
+    Set the field of the document d at the dotted path, e.g. "qp_energies.1.fs_id".
+    """
+    *parents, key = path.split(".")
+    for k in parents:
+        d = d[k]
+    d[key] = value
+
+
+def parse_task_label(task_label):
+    """
+    (stage, iteration) of a task label, e.g. ("scGW", 3) for "scGW_Iteration: 3"
+    and ("BSE", None) for "BSE".
+    """
+    if not task_label:
+        return None, None
+    match = re.match(r"^(.*)_Iteration:\s*(\d+)$", task_label)
+    if match:
+        return match.group(1), int(match.group(2))
+    return task_label, None
+
+
+def query_fields(d, workflow_id=None):
+    """
+    Structured query fields of the result document d: stage and iteration of its
+    task_label, GW parameters of its INCAR ({"NBANDS": ..., "ENCUTGW": ...,
+    "NOMEGA": ...}) and the id of its workflow.
+    """
+    stage, iteration = parse_task_label(d.get("task_label"))
+    fields = {"stage": stage, "iteration": iteration, "workflow_id": workflow_id}
+    incar = d.get("incar")
+    if incar and any(p in incar for p in GW_PARAMS[1:]):
+        fields["gw_params"] = {p: incar.get(p) for p in GW_PARAMS}
+    return fields
+
+
+def natural_key(d):
+    """
+    Filter of the document with the natural key (NATURAL_KEY) of d, None if a
+    field of REQUIRED_KEY is missing: results without a material id cannot be
+    told apart and must all be kept. The workflow id is not part of the key, a
+    workflow submitted again for a material replaces its results.
+    """
+    if any(d.get(k) is None for k in REQUIRED_KEY):
+        return None
+    return {k: d.get(k) for k in NATURAL_KEY}
+
+
+def ensure_indexes(mmdb, collection):
+    """
+    Create the indexes of a result collection, once per process.
+    """
+    key = (mmdb.host, mmdb.port, mmdb.db_name, collection)
+    if key in _indexed:
+        return
+    _create_indexes(mmdb.db[collection])
+    _indexed.add(key)
+
+
+def _create_indexes(coll):
+    # the natural key has the fields of the compound index
+    coll.create_index([(f, ASCENDING) for f in INDEX_FIELDS])
+    coll.create_index("workflow_id")
+
+
+def upsert_result(mmdb, collection, d):
+    """
+    Replace the document of collection with the natural key of d by d (the
+    replaced document keeps its _id), or insert d if there is no such document
+    or d has no natural key. Returns the id of the document.
+    """
+    ensure_indexes(mmdb, collection)
+    key = natural_key(d)
+    if key is None:
+        return mmdb.db[collection].insert_one(d).inserted_id
+    d = {k: v for k, v in d.items() if k != "_id"}
+    doc = mmdb.db[collection].find_one_and_replace(key, d, projection={"_id": 1}, upsert=True,
+                                                   return_document=ReturnDocument.AFTER)
+    return doc["_id"]
+
+
+def backfill_query_fields(db, collections=None):
+    """
+    Add the structured query fields to the result documents written before they
+    existed (the workflow id is unknown and left empty), and create the indexes.
+
+    Args:
+        db: pymongo Database, e.g. VaspCalcDb.from_db_file(db_file).db.
+        collections ([str]): result collections, default: RESULT_COLLECTIONS.
+
+    Returns:
+        number of updated documents.
+    """
+    n = 0
+    for collection in collections or RESULT_COLLECTIONS:
+        coll = db[collection]
+        requests = []
+        for d in coll.find({"stage": {"$exists": False}}, {"task_label": 1, "incar": 1}):
+            requests.append(UpdateOne({"_id": d["_id"]}, {"$set": query_fields(d)}))
+            if len(requests) == 1000:
+                n += coll.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            n += coll.bulk_write(requests, ordered=False).modified_count
+        _create_indexes(coll)
+    return n
@@ -0,0 +1,256 @@
+# coding: utf-8
+
+"""
+This module defines the write-behind journal of the results. Instead of
+inserting its document in the database from the job allocation, an out2db task
+appends it to a local append-only journal and returns right away; the journal is
+flushed later to the database, in bulk, by the FlushJournal Firetask or by a
+separate flusher process:
+
+    python -m pyGWBSE.journal /path/to/journals --interval 300
+
+Each line of a journal is one entry, in MongoDB extended JSON. The ids of the
+flushed entries are appended to <journal>.done; an entry that was written but
+not yet recorded as flushed (e.g. the flusher died) replaces its own document
+again (entries with a natural key, whose _id is assigned by the upsert as for a
+direct write) or is skipped by the database as a duplicate _id (the other
+entries, whose _id is given when they are journaled), so a journal can be
+replayed any number of times.
+"""
+
+import argparse
+import hashlib
+import os
+import time
+
+import gridfs
+from atomate.utils.utils import get_logger
+from bson import ObjectId, json_util
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from pyGWBSE.database import get_db, set_field, ensure_indexes
+
+logger = get_logger(__name__)
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# name of the journal written in a launch directory
+JOURNAL_FILE = "pygwbse_journal.jsonl"
+
+# extension of the journals
+JOURNAL_EXT = ".jsonl"
+
+# extension of the list of flushed entries of a journal
+DONE_EXT = ".done"
+
+# error code of a duplicate key
+DUPLICATE_KEY = 11000
+
+
+def journal_path(journal, launch_dir=None):
+    """
+    Journal of the launch directory: journal=True is the JOURNAL_FILE of the
+    launch directory, a directory is a journal named after the launch directory
+    in that (shared) directory.
+    """
+    launch_dir = os.path.abspath(launch_dir or os.getcwd())
+    if journal is True:
+        return os.path.join(launch_dir, JOURNAL_FILE)
+    journal = os.path.expandvars(os.path.expanduser(journal))
+    os.makedirs(journal, exist_ok=True)
+    return os.path.join(journal, "pygwbse-{}{}".format(hashlib.sha1(launch_dir.encode()).hexdigest()[:16],
+                                                      JOURNAL_EXT))
+
+
+def journal_insert(journal, db_file, collection, doc, files=None, key=None):
+    """
+    Append the insertion of doc in collection to the journal. The entry is
+    written with a single write and synced to disk before returning.
+
+    Args:
+        journal (str): path of the journal, see journal_path.
+        db_file (str): path to the file containing the database credentials.
+        collection (str): collection of the document.
+        doc (dict): document, its _id is set from the id of the entry if it has
+            no natural key.
+        files ({str: (str, bytes, dict)}): files stored in GridFS when the entry
+            is flushed, {dotted path of a field of doc: (GridFS bucket, content,
+            metadata)}; the contents are written next to the journal.
+        key (dict): natural key of doc, the document with this key is replaced
+            by doc when the entry is flushed, see pyGWBSE.database.natural_key.
+
+    Returns:
+        id of the document, None if it is assigned when the entry is flushed.
+    """
+    entry_id = ObjectId()
+    doc_id = entry_id if key is None else None
+    doc = dict(doc, _id=doc_id) if key is None else {k: v for k, v in doc.items() if k != "_id"}
+    entry = {"id": str(entry_id), "time": time.time(), "db_file": os.path.abspath(db_file),
+             "collection": collection, "doc": doc, "key": key, "files": {}}
+    for field, (bucket, data, metadata) in (files or {}).items():
+        fname = "{}.{}.{}".format(os.path.basename(journal), entry["id"], field)
+        _write(os.path.join(os.path.dirname(journal), fname), data, "wb")
+        entry["files"][field] = {"bucket": bucket, "path": fname, "metadata": metadata, "id": str(ObjectId())}
+    line = json_util.dumps(entry) + "\n"
+    # an entry truncated by a crash is terminated so the new one stays readable
+    if os.path.exists(journal) and os.path.getsize(journal) > 0:
+        with open(journal, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+    _write(journal, line.encode(), "ab")
+    return doc_id
+
+
+def read_journal(journal):
+    """
+    Entries of the journal that are not flushed yet. An incomplete entry (the
+    writer died while writing it) is skipped.
+    """
+    done = set()
+    if os.path.exists(journal + DONE_EXT):
+        with open(journal + DONE_EXT) as f:
+            done = set(f.read().split())
+    entries = []
+    with open(journal) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json_util.loads(line)
+            except ValueError:
+                logger.warning("Skipping an incomplete entry of {}".format(journal))
+                continue
+            if entry["id"] not in done:
+                entries.append(entry)
+    return entries
+
+
+def flush_journal(journal, db_file=None, batch_size=100, retries=5, backoff=2.):
+    """
+    Write the pending entries of the journal in the database, batch_size
+    documents per bulk write, and record them as flushed. A failed batch is
+    retried with an exponential backoff. The entries with a natural key replace
+    the document of their key, the others are inserted and skipped if they
+    already are in the database, so replaying a journal writes every document
+    once.
+
+    Args:
+        journal (str): path of the journal.
+        db_file (str): database of all the entries, default: the db_file of
+            each entry.
+        batch_size (int): number of documents per bulk write.
+        retries (int): number of retries of a failed batch.
+        backoff (float): seconds before the first retry, doubled each retry.
+
+    Returns:
+        number of flushed entries.
+    """
+    batches = {}
+    for entry in read_journal(journal):
+        batches.setdefault((db_file or entry["db_file"], entry["collection"]), []).append(entry)
+    nflushed = 0
+    for (db, collection), entries in batches.items():
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i + batch_size]
+            for attempt in range(retries + 1):
+                try:
+                    _insert_batch(get_db(db), collection, batch, os.path.dirname(journal))
+                    break
+                except PyMongoError as exc:
+                    if attempt == retries:
+                        raise
+                    logger.warning("Flushing {} to {} failed, retrying: {}".format(journal, collection, exc))
+                    time.sleep(backoff * 2 ** attempt)
+            _write(journal + DONE_EXT, "".join(entry["id"] + "\n" for entry in batch).encode(), "ab")
+            for entry in batch:
+                for f in entry["files"].values():
+                    path = os.path.join(os.path.dirname(journal), f["path"])
+                    if os.path.exists(path):
+                        os.remove(path)
+            nflushed += len(batch)
+    if nflushed:
+        logger.info("{}: {} entries flushed".format(journal, nflushed))
+    return nflushed
+
+
+def flush_journals(paths, db_file=None, **kwargs):
+    """
+    Flush the journals of paths, journals or directories searched recursively
+    for journals, see flush_journal for kwargs. A journal that cannot be
+    flushed is left pending and reported with its error.
+
+    Returns:
+        [dict] of the journal, number of flushed entries and error.
+    """
+    journals = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        if os.path.isfile(path):
+            journals.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            journals.extend(os.path.join(root, f) for f in sorted(files)
+                            if f == JOURNAL_FILE or (f.startswith("pygwbse-") and f.endswith(JOURNAL_EXT)))
+    report = []
+    for journal in journals:
+        try:
+            report.append({"journal": journal, "flushed": flush_journal(journal, db_file, **kwargs), "error": None})
+        except (PyMongoError, OSError) as exc:
+            logger.error("Cannot flush {}: {}".format(journal, exc))
+            report.append({"journal": journal, "flushed": 0, "error": str(exc)})
+    return report
+
+
+def _insert_batch(mmdb, collection, batch, journal_dir):
+    for entry in batch:
+        for field, f in entry["files"].items():
+            fs = gridfs.GridFS(mmdb.db, f["bucket"])
+            file_id = ObjectId(f["id"])
+            if not fs.exists(file_id):
+                # chunks of an interrupted upload
+                fs.delete(file_id)
+                with open(os.path.join(journal_dir, f["path"]), "rb") as data:
+                    fs.put(data, _id=file_id, metadata=f["metadata"])
+            set_field(entry["doc"], field, file_id)
+    ensure_indexes(mmdb, collection)
+    upserts = [ReplaceOne(entry["key"], entry["doc"], upsert=True) for entry in batch if entry.get("key") is not None]
+    if upserts:
+        # in order, the last entry of a key wins
+        mmdb.db[collection].bulk_write(upserts, ordered=True)
+    inserts = [entry["doc"] for entry in batch if entry.get("key") is None]
+    if not inserts:
+        return
+    try:
+        mmdb.db[collection].insert_many(inserts, ordered=False)
+    except BulkWriteError as exc:
+        errors = [e for e in exc.details.get("writeErrors", []) if e.get("code") != DUPLICATE_KEY]
+        if errors or exc.details.get("writeConcernErrors"):
+            raise
+
+
+def _write(path, data, mode):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flush the pyGWBSE result journals to the database.")
+    parser.add_argument("paths", nargs="+", help="journals or directories searched for journals")
+    parser.add_argument("--db_file", default=None, help="database of all the entries")
+    parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0,
+                        help="flush again every interval seconds, 0 to flush once")
+    args = parser.parse_args()
+    while True:
+        flush_journals(args.paths, args.db_file, batch_size=args.batch_size)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
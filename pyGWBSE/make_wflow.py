@@ -1,7 +1,8 @@
 #This code is to create the workflow based on inputs from input.yaml file 
 
 from fireworks import Firework, Workflow
-from pyGWBSE.wflows import ScfFW, convFW, BseFW, GwFW, EmcFW, WannierCheckFW, WannierFW
+from pyGWBSE.wflows import ScfFW, convFW, BseFW, GwFW, EmcFW, WannierCheckFW, WannierFW, add_compression, \
+                           use_scratch, use_journal, use_array_storage, use_staging, add_workflow_id
 from pyGWBSE.inputset import CreateInputs 
 from pymatgen.core import Structure
 from fireworks import LaunchPad
@@ -82,6 +83,11 @@ def create_wfs(struct, params_dict, vasp_cmd=None, sumo_cmd=None, wannier_cmd=No
     skip_gw=params_dict["WFLOW_DESIGN"]["skip_gw"]
     scgw=params_dict["WFLOW_DESIGN"]["scgw"]
     skip_bse=params_dict["WFLOW_DESIGN"]["skip_bse"]
+    compress_outputs=params_dict["WFLOW_DESIGN"].get("compress_outputs", False)
+    scratch_dir=params_dict["WFLOW_DESIGN"].get("scratch_dir", None)
+    db_journal=params_dict["WFLOW_DESIGN"].get("db_journal", None)
+    array_storage=params_dict["WFLOW_DESIGN"].get("array_storage", False)
+    staging=params_dict["WFLOW_DESIGN"].get("staging", "copy")
 
     mesh,nkpt=num_ir_kpts(struct,rd, two_dim=two_dim)
     nbands=(int(nocc/ppn)+1)*ppn
@@ -127,7 +133,7 @@ def create_wfs(struct, params_dict, vasp_cmd=None, sumo_cmd=None, wannier_cmd=No
     parents = fws[0]
     fw = convFW(structure=struct, mat_name=mat_name, nbands=nbands, nbgwfactor=nbgwfactor, encutgw=encutgw, nomegagw=nomegagw, convsteps=convsteps, conviter=conviter, 
                     tolerence=0.1, no_conv=skip_conv, vasp_cmd=vasp_cmd,db_file=db_file,parents=parents,kpar=kpar,
-                nbandsgw=nbandsgw,reciprocal_density=rd, two_dim=two_dim)
+                nbandsgw=nbandsgw,reciprocal_density=rd, two_dim=two_dim, prefetch_consumers=int(not skip_gw))
     fws.append(fw)
 
     if skip_gw==False:
@@ -135,7 +141,8 @@ def create_wfs(struct, params_dict, vasp_cmd=None, sumo_cmd=None, wannier_cmd=No
         parents = fws[ifw-1]
         fw = GwFW(structure=struct, mat_name=mat_name, tolerence=0.1, no_conv=not(scgw),
                 vasp_cmd=vasp_cmd,db_file=db_file,parents=parents,reciprocal_density=rd, nbandsgw=nbandsgw,
-                  wannier_fw=not(skip_wannier), job_tag=gw_tag, two_dim=two_dim)
+                  wannier_fw=not(skip_wannier), job_tag=gw_tag, two_dim=two_dim,
+                  prefetch_consumers=int(not skip_wannier)+int(not skip_bse))
         fws.append(fw)
 
     if skip_wannier==False and skip_gw==False:
@@ -159,8 +166,26 @@ def create_wfs(struct, params_dict, vasp_cmd=None, sumo_cmd=None, wannier_cmd=No
                    job_tag=gw_tag+'-BSE', two_dim=two_dim)
         fws.append(fw)
 
+    if compress_outputs:
+        for fw in fws:
+            add_compression(fw, compress_outputs if isinstance(compress_outputs, dict) else None)
 
-    wf_gwbse = Workflow(fws)
+    wf_gwbse = add_workflow_id(Workflow(fws))
+
+    if scratch_dir:
+        use_scratch(wf_gwbse, scratch_dir)
+
+    if array_storage:
+        use_array_storage(wf_gwbse, array_storage)
+
+    if staging and staging != "copy":
+        use_staging(wf_gwbse, staging)
+
+    if db_journal:
+        # the last Firework flushes the journals once every Firework ran; the
+        # results of a workflow with a fizzled Firework are flushed with
+        # python -m pyGWBSE.journal
+        use_journal(wf_gwbse, db_journal, fw_name=mat_name+"-flush_journal")
 
     return wf_gwbse
 
@@ -1,14 +1,17 @@
 # coding: utf-8
 
-import glob
 import os
 
+import gridfs
+
 from atomate.utils.utils import env_chk
-from atomate.vasp.database import VaspCalcDb
 from fireworks import explicit_serialize, FiretaskBase, FWAction
 from monty.json import jsanitize
-from pymatgen.io.vasp.outputs import Vasprun, Outcar
 
+from pyGWBSE.arrays import BINARY_FIELDS, pack_arrays
+from pyGWBSE.database import get_db, set_field, query_fields, natural_key, upsert_result
+from pyGWBSE.journal import journal_insert, journal_path, flush_journals
+from pyGWBSE.readers import LazyVasprun, OutcarTail, find_file
 from pyGWBSE.tasks import read_emcpyout, read_epsilon, get_gap_from_dict, read_vac_level
 from pyGWBSE.wannier_tasks import read_vbm, read_wannier, read_vasp, read_special_kpts
 
@@ -19,7 +22,7 @@ class gw2db(FiretaskBase):
     Insert quasi-particle energies into the database for a GW calculation.
     """
     required_params = ["structure", "task_label", "db_file", "mat_name"]
-    optional_params = ["job_tag", "defuse_unsuccessful"]
+    optional_params = ["job_tag", "defuse_unsuccessful", "journal", "array_storage"]
 
     def run_task(self, fw_spec):
         """
@@ -27,7 +30,6 @@ class gw2db(FiretaskBase):
         """
         # get adddtional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         ifconv = fw_spec["ifconv"]
         structure = self["structure"]
         task_label = self["task_label"]
@@ -38,14 +40,14 @@ class gw2db(FiretaskBase):
         mat_name = self["mat_name"]
         task_collection = 'QP_Results'
         dir_name = os.getcwd()
-        file = glob.glob('vasprun.xml*')[-1]
-        vasprun = Vasprun(file)
-        file = glob.glob('OUTCAR*')[-1]
-        outcar = Outcar(file)
+        file = find_file('.', 'vasprun.xml', required=True)
+        vasprun = LazyVasprun(file, profile="gw2db")
+        file = find_file('.', 'OUTCAR', required=True)
+        outcar = OutcarTail(file)
         run_stats=outcar.run_stats
         qp_energies = vasprun.eigenvalues
         en, eps1, eps2 = vasprun.dielectric
-        igap, dgap = get_gap_from_dict(qp_energies)
+        igap, dgap = get_gap_from_dict(vasprun.eigenvalue_set)
         incar = vasprun.incar
         parameters = vasprun.parameters
         bgap, cbm, vbm, is_band_gap_direct = vasprun.eigenvalue_band_properties
@@ -60,8 +62,9 @@ class gw2db(FiretaskBase):
              "job_tag": job_tag, "ifconv": ifconv, "vbm": vbm, "cbm": cbm, 
              "incar": incar, "parameters": parameters, "kpoints": kpts_dict}
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        d, files = pack_result(self, d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec), files,
+                      workflow_id=fw_spec.get("wf_uuid"))
 
         return FWAction(update_spec={"gw_gaps": [igap, dgap]})   
 
@@ -70,9 +73,15 @@ class gw2db(FiretaskBase):
 class bse2db(FiretaskBase):
     """
     Insert exciton energies, oscillator strength and dielectric function into the database for a BSE calculation.
+    The vasprun.xml of a BSE run is often truncated, it is read as it is without modifying the file.
+
+    Other Parameters:
+        max_transitions (int): store only the optical transitions with the largest oscillator strengths.
+        transition_energy_cutoff (float): store only the optical transitions below this energy (eV).
     """
     required_params = ["structure", "task_label", "db_file", "mat_name"]
-    optional_params = ["job_tag", "defuse_unsuccessful"]
+    optional_params = ["job_tag", "defuse_unsuccessful", "max_transitions", "transition_energy_cutoff", "journal",
+                       "array_storage"]
 
     def run_task(self, fw_spec):
         """
@@ -80,7 +89,6 @@ class bse2db(FiretaskBase):
         """
         # get adddtional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         structure = self["structure"]
         task_label = self["task_label"]
         job_tag = self["job_tag"]
@@ -89,22 +97,22 @@ class bse2db(FiretaskBase):
         dgap = fw_spec["gw_gaps"][1]
         task_collection = 'BSE_Results'
         dir_name = os.getcwd()
-        filename = glob.glob('vasprun.xml*')[-1]
+        filename = find_file('.', 'vasprun.xml', required=True)
         if "job_tag" in self:
             job_tag = self["job_tag"]
         else:
             job_tag = None
-        with open(filename, "a") as file:
-            file.write("</modeling>")
-        vasprun = Vasprun(filename, exception_on_bad_xml=False)
+        vasprun = LazyVasprun(filename, profile="bse2db", exception_on_bad_xml=False,
+                              max_transitions=self.get("max_transitions"),
+                              transition_energy_cutoff=self.get("transition_energy_cutoff"))
         incar = vasprun.incar
         parameters = vasprun.parameters
         optical_transition = vasprun.optical_transition
         en, eps1, eps2 = vasprun.dielectric
         kpts_dict = vasprun.kpoints.as_dict()
-        file = glob.glob('OUTCAR*')[-1]                                         
-        outcar = Outcar(file)                                                   
-        run_stats=outcar.run_stats                                              
+        file = find_file('.', 'OUTCAR', required=True)
+        outcar = OutcarTail(file)
+        run_stats=outcar.run_stats
         d = {"structure": structure.as_dict(),
              "formula_pretty": structure.composition.reduced_formula,
              "material_id": mat_name, "run_directory": dir_name,
@@ -113,8 +121,9 @@ class bse2db(FiretaskBase):
              "optical_transition": optical_transition, "task_label": task_label, "job_tag": job_tag,
              "incar": incar, "parameters": parameters, "kpoints": kpts_dict}
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        d, files = pack_result(self, d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec), files,
+                      workflow_id=fw_spec.get("wf_uuid"))
 
 @explicit_serialize
 class rpa2db(FiretaskBase):
@@ -122,7 +131,7 @@ class rpa2db(FiretaskBase):
     Insert exciton energies, oscillator strength and dielectric function into the database for a BSE calculation.
     """
     required_params = ["structure", "task_label", "db_file", "mat_name"]
-    optional_params = ["defuse_unsuccessful"]
+    optional_params = ["defuse_unsuccessful", "journal", "array_storage"]
 
     def run_task(self, fw_spec):
         """
@@ -130,31 +139,25 @@ class rpa2db(FiretaskBase):
         """
         # get adddtional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         structure = self["structure"]
         task_label = self["task_label"]
         mat_name = self["mat_name"]
         task_collection = 'RPA_Results'
         dir_name = os.getcwd()
-        filename = glob.glob('vasprun.xml*')[-1]
-        vasprun = Vasprun(filename)
-        incar = vasprun.incar
-        parameters = vasprun.parameters
-        dft_energies = vasprun.eigenvalues
-        en, eps1, eps2 = vasprun.dielectric
-        kpts_dict = vasprun.kpoints.as_dict()
-        file = glob.glob('OUTCAR*')[-1]                                         
-        outcar = Outcar(file)                                                   
-        run_stats=outcar.run_stats                                              
+        filename = find_file('.', 'vasprun.xml', required=True)
+        vasprun = LazyVasprun(filename, profile="rpa2db")
+        file = find_file('.', 'OUTCAR', required=True)
+        outcar = OutcarTail(file)
+        run_stats=outcar.run_stats
         d = {"structure": structure.as_dict(),
              "formula_pretty": structure.composition.reduced_formula,
              "material_id": mat_name, "run_directory": dir_name,
-             "dft_energies": dft_energies, "run_stats": run_stats,
-             "frequency": en, "epsilon_1": eps1, "epsilon_2": eps2, "task_label": task_label,
-             "incar": incar, "parameters": parameters, "kpoints": kpts_dict}
+             "task_label": task_label}
+        d.update(get_rpa_results(vasprun, run_stats))
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        d, files = pack_result(self, d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec), files,
+                      workflow_id=fw_spec.get("wf_uuid"))
 
 @explicit_serialize
 class emc2db(FiretaskBase):
@@ -162,7 +165,7 @@ class emc2db(FiretaskBase):
     Insert effective masses for a SUMO-BANDSTATS calculation.
     """
     required_params = ["structure", "db_file", "mat_name"]
-    optional_params = ["defuse_unsuccessful"]
+    optional_params = ["defuse_unsuccessful", "journal"]
 
     def run_task(self, fw_spec):
         """
@@ -171,11 +174,10 @@ class emc2db(FiretaskBase):
         # get adddtional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
         dir_name = os.getcwd()
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         structure = self["structure"]
         mat_name = self["mat_name"]
         task_collection = 'EMC_Results'
-        filename = glob.glob('sumo-bandstats.log*')[-1]
+        filename = find_file('.', 'sumo-bandstats.log', required=True)
         hmass, emass = read_emcpyout(filename)
         # dictionary to update the database with
         d = {"structure": structure.as_dict(),
@@ -183,16 +185,24 @@ class emc2db(FiretaskBase):
             "material_id": mat_name, "run_directory": dir_name,
             "hole_effective_mass": hmass, "electron_effective_mass": emass}
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec),
+                      workflow_id=fw_spec.get("wf_uuid"))
 
 @explicit_serialize
 class eps2db(FiretaskBase):
     """
     Insert macroscopic dielectric constants for LEPSILON=TRUE calculation.
+
+    The projected eigenvalues are stored summed over the atoms of each group (one
+    group per species unless projection_groups is given) and over each l channel
+    in "projected_eigs_reduced", {spin: array(nkpt, nband, ngroups, nl)}, with the
+    group and l names in "projection_groups" and "projection_orbitals". With
+    full_projections=True the full projections {spin: array(nkpt, nband, nion,
+    norb)} are also stored in "projected_eigs", always as binary arrays (see
+    pack_result); they are held in memory while vasprun.xml is read.
     """
     required_params = ["structure", "db_file", "mat_name"]
-    optional_params = ["defuse_unsuccessful"]
+    optional_params = ["defuse_unsuccessful", "projection_groups", "full_projections", "journal", "array_storage"]
 
     def run_task(self, fw_spec):
         """
@@ -200,43 +210,160 @@ class eps2db(FiretaskBase):
         """
         # get additional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         dir_name = os.getcwd()
         structure = self["structure"]
         mat_name = self["mat_name"]
         task_collection = 'EPS_Results'
-        filename = glob.glob('vasprun.xml*')[-1]
-        try:
-            locpot_fname = glob.glob('LOCPOT*')[-1]
-            zvac, evac, delta_evac=read_vac_level(locpot_fname, filename)
-            ifvac=True
-        except:
-            ifvac=False
-        epsilon = read_epsilon(filename)
-        vrun = Vasprun(filename, parse_projected_eigen=True)
-        ks_energies = vrun.eigenvalues
-        proj_eigs=vrun.projected_eigenvalues
-        kwgs=vrun.actual_kpoints_weights
-        file = glob.glob('OUTCAR*')[-1]                                         
-        outcar = Outcar(file)                                                   
-        run_stats=outcar.run_stats                                              
-        igap, dgap = get_gap_from_dict(ks_energies)
-        bgap, cbm, vbm, is_band_gap_direct = vrun.eigenvalue_band_properties
+        filename = find_file('.', 'vasprun.xml', required=True)
+        vrun = LazyVasprun(filename, profile="eps2db", projection_groups=self.get("projection_groups"),
+                           full_projections=self.get("full_projections", False))
+        locpot_fname = find_file('.', 'LOCPOT')
+        file = find_file('.', 'OUTCAR', required=True)
+        outcar = OutcarTail(file)
+        run_stats=outcar.run_stats
         # dictionary to update the database with
         d = {"structure": structure.as_dict(),
                 "formula_pretty": structure.composition.reduced_formula,
-                "material_id": mat_name, "dielectric constant": epsilon, 
-                "run_stats": run_stats, "run_directory": dir_name, 
-                'direct_gap': dgap, 'indirect_gap': igap,
-                "kpoint_weights": kwgs, "cbm": cbm, "vbm": vbm,
-                "projected_eigs": proj_eigs, "ks_energies": ks_energies}
-        if ifvac:
-            d.update({"z_vacuum": zvac, "e_vacuum": evac, "delta_e_vacuum": delta_evac})
+                "material_id": mat_name, "run_directory": dir_name}
+        d.update(get_eps_results(vrun, run_stats, locpot_fname))
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        d, files = pack_result(self, d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec), files,
+                      workflow_id=fw_spec.get("wf_uuid"))
 
 
+@explicit_serialize
+class scf2db(FiretaskBase):
+    """
+    Insert the results of the SCF calculation into both EPS_Results and RPA_Results.
+    vasprun.xml, OUTCAR and LOCPOT are parsed only once and the parsed outputs are
+    shared between the two documents, instead of running eps2db and rpa2db separately.
+    The projections are stored as in eps2db.
+    """
+    required_params = ["structure", "task_label", "db_file", "mat_name"]
+    optional_params = ["defuse_unsuccessful", "projection_groups", "full_projections", "journal", "array_storage"]
+
+    def run_task(self, fw_spec):
+        """
+        Your Comments Here
+        """
+        db_file = env_chk(self.get('db_file'), fw_spec)
+        dir_name = os.getcwd()
+        structure = self["structure"]
+        task_label = self["task_label"]
+        mat_name = self["mat_name"]
+        filename = find_file('.', 'vasprun.xml', required=True)
+        vrun = LazyVasprun(filename, profile="scf2db", projection_groups=self.get("projection_groups"),
+                           full_projections=self.get("full_projections", False))
+        locpot_fname = find_file('.', 'LOCPOT')
+        file = find_file('.', 'OUTCAR', required=True)
+        outcar = OutcarTail(file)
+        run_stats=outcar.run_stats
+        d = {"structure": structure.as_dict(),
+             "formula_pretty": structure.composition.reduced_formula,
+             "material_id": mat_name, "run_directory": dir_name}
+        d_eps = dict(d)
+        d_eps.update(get_eps_results(vrun, run_stats, locpot_fname))
+        d_eps, files = pack_result(self, jsanitize(d_eps))
+        d_rpa = dict(d, task_label=task_label)
+        d_rpa.update(get_rpa_results(vrun, run_stats))
+        d_rpa, files_rpa = pack_result(self, jsanitize(d_rpa))
+        journal = get_journal(self, fw_spec)
+        insert_result(db_file, 'EPS_Results', d_eps, journal, files,
+                      workflow_id=fw_spec.get("wf_uuid"))
+        insert_result(db_file, 'RPA_Results', d_rpa, journal, files_rpa,
+                      workflow_id=fw_spec.get("wf_uuid"))
+
+
+def get_rpa_results(vrun, run_stats):
+    """
+    Collect the RPA_Results fields (KS energies, RPA dielectric function, INCAR,
+    parameters and k-points) from a LazyVasprun (or Vasprun) of the SCF run.
+    """
+    en, eps1, eps2 = vrun.dielectric
+    d = {"dft_energies": vrun.eigenvalues, "run_stats": run_stats,
+         "frequency": en, "epsilon_1": eps1, "epsilon_2": eps2,
+         "incar": vrun.incar, "parameters": vrun.parameters,
+         "kpoints": vrun.kpoints.as_dict()}
+    return d
+
+
+def get_eps_results(vrun, run_stats, locpot_fname=None):
+    """
+    Collect the EPS_Results fields (dielectric constant, KS energies, projections,
+    gaps and vacuum level) from a LazyVasprun of the SCF run; the full projections
+    are only there if they were kept, see eps2db.
+    The vacuum level is added only when locpot_fname is given and can be read.
+    """
+    ks_energies = vrun.eigenvalues
+    igap, dgap = get_gap_from_dict(ks_energies)
+    bgap, cbm, vbm, is_band_gap_direct = vrun.eigenvalue_band_properties
+    d = {"dielectric constant": read_epsilon(vrun),
+         "run_stats": run_stats,
+         'direct_gap': dgap, 'indirect_gap': igap,
+         "kpoint_weights": vrun.actual_kpoints_weights, "cbm": cbm, "vbm": vbm,
+         "projected_eigs_reduced": vrun.projections, "projection_groups": vrun.projection_labels,
+         "projection_orbitals": vrun.projection_orbitals, "ks_energies": ks_energies}
+    if vrun.projected_eigenvalues is not None:
+        d["projected_eigs"] = vrun.projected_eigenvalues
+    if locpot_fname:
+        try:
+            zvac, evac, delta_evac = read_vac_level(locpot_fname, vrun)
+            d.update({"z_vacuum": zvac, "e_vacuum": evac, "delta_e_vacuum": delta_evac})
+        except:
+            pass
+    return d
+
+
+def get_journal(task, fw_spec):
+    """
+    Result journal of an out2db task: its "journal" parameter, default
+    >>db_journal<< of the FWorker env; None to insert the results right away.
+    """
+    return env_chk(task.get("journal", ">>db_journal<<"), fw_spec, strict=False)
+
+
+def pack_result(task, d, files=None):
+    """
+    Encode the large arrays of the document d as binary arrays when the task has
+    array_storage: True, or the arguments of pyGWBSE.arrays.pack_arrays (e.g.
+    {"dtype": "float32"}); the BINARY_FIELDS (e.g. the full projections) are
+    encoded in any case. Returns d and its files for insert_result.
+    """
+    array_storage = task.get("array_storage")
+    if not array_storage:
+        d, array_files = pack_arrays(d, BINARY_FIELDS)
+        return d, dict(files or {}, **array_files) if array_files else files
+    d, array_files = pack_arrays(d, **(array_storage if isinstance(array_storage, dict) else {}))
+    return d, dict(files or {}, **array_files)
+
+
+def insert_result(db_file, collection, d, journal=None, files=None, workflow_id=None):
+    """
+    Write the document d, with its structured query fields (see
+    pyGWBSE.database.query_fields), in collection: it replaces the document of
+    the same natural key (a rerun) or is inserted. With journal, d is appended to
+    the result journal instead (see pyGWBSE.journal).
+
+    Args:
+        db_file (str): path to the file containing the database credentials.
+        collection (str): collection of the document.
+        d (dict): document.
+        journal (bool or str): True for a journal in the launch directory, a
+            directory for a journal in that directory, None to write d now.
+        files ({str: (str, bytes, dict)}): files stored in GridFS, {dotted path of
+            a field of d: (GridFS bucket, content, metadata)}, the field is set
+            to the file id.
+        workflow_id (str): id of the workflow, "wf_uuid" of the fw_spec.
+    """
+    d.update(query_fields(d, workflow_id))
+    if journal:
+        return journal_insert(journal_path(journal), db_file, collection, d, files, key=natural_key(d))
+    mmdb = get_db(db_file)
+    for field, (bucket, data, metadata) in (files or {}).items():
+        set_field(d, field, gridfs.GridFS(mmdb.db, bucket).put(data, metadata=metadata))
+    return upsert_result(mmdb, collection, d)
+
 
 @explicit_serialize
 class Wannier2DB(FiretaskBase):
@@ -253,7 +380,7 @@ class Wannier2DB(FiretaskBase):
     """
 
     required_params = ["structure", "task_label", "db_file", "compare_vasp", "mat_name"]
-    optional_params = ["defuse_unsuccessful"]
+    optional_params = ["defuse_unsuccessful", "journal", "array_storage"]
 
     def run_task(self, fw_spec):
         """
@@ -261,17 +388,16 @@ class Wannier2DB(FiretaskBase):
         """
         # get adddtional tags to parse the directory for
         db_file = env_chk(self.get('db_file'), fw_spec)
-        mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         structure = self["structure"]
         task_label = self["task_label"]
         compare_vasp = self["compare_vasp"]
         mat_name = self["mat_name"]
         task_collection = 'WANNIER_Results'
         dir_name = os.getcwd()
-        fname_band = glob.glob('wannier90_band.dat*')[-1]
-        fname_kpt = glob.glob('wannier90_band.kpt*')[-1]
-        fname_gnu = glob.glob('wannier90_band.gnu*')[-1]
-        fname_vasp = glob.glob('vasprun.xml*')[-1]
+        fname_band = find_file('.', 'wannier90_band.dat', required=True)
+        fname_kpt = find_file('.', 'wannier90_band.kpt', required=True)
+        fname_gnu = find_file('.', 'wannier90_band.gnu', required=True)
+        fname_vasp = find_file('.', 'vasprun.xml', required=True)
         gap, vbm = read_vbm(fname_vasp)
         kpts, eigs_wann = read_wannier(fname_band, fname_kpt, vbm)
         spkptl, spkptc = read_special_kpts(fname_gnu)
@@ -296,5 +422,38 @@ class Wannier2DB(FiretaskBase):
                  "special_kpoint_coordinates": spkptc,
                  "task_label": task_label}
         d = jsanitize(d)
-        coll = mmdb.db[task_collection]
-        coll.insert_one(d)
+        d, files = pack_result(self, d)
+        insert_result(db_file, task_collection, d, get_journal(self, fw_spec), files,
+                      workflow_id=fw_spec.get("wf_uuid"))
+
+
+@explicit_serialize
+class FlushJournal(FiretaskBase):
+    """
+    Flush the result journals of the out2db tasks to the database, see
+    pyGWBSE.journal. The task fails if a journal cannot be flushed, its pending
+    entries are flushed again when it is rerun.
+
+    Other Parameters:
+        journal (bool or str): directory of the journals, default: >>db_journal<<
+            of the FWorker env; True for the journals of the launch directories
+            next to the launch directory of this task.
+        db_file (str): database of all the entries, default: the db_file
+            recorded in each entry. Supports env_chk.
+        batch_size (int): number of documents per bulk write.
+        retries (int): number of retries of a failed batch.
+    """
+    optional_params = ["journal", "db_file", "batch_size", "retries"]
+
+    def run_task(self, fw_spec):
+        journal = env_chk(self.get("journal", ">>db_journal<<"), fw_spec, strict=False)
+        if not journal:
+            return
+        path = os.path.dirname(os.getcwd()) if journal is True else os.path.expandvars(os.path.expanduser(journal))
+        db_file = env_chk(self.get("db_file"), fw_spec, strict=False)
+        report = flush_journals(path, db_file, batch_size=self.get("batch_size", 100),
+                                retries=self.get("retries", 5))
+        failed = [r["journal"] for r in report if r["error"]]
+        if failed:
+            raise RuntimeError("Cannot flush the journals {}".format(", ".join(failed)))
+        return FWAction(stored_data={"flushed": sum(r["flushed"] for r in report), "journals": len(report)})
@@ -0,0 +1,173 @@
+# coding: utf-8
+
+"""
+This module defines the pruning of the large intermediate files (WAVECAR, WAVEDER,
+CHGCAR, W*.tmp, ...) of a workflow. A file of a completed Firework is removed, or
+moved to an archive directory, once every child Firework that copies it from the
+run directory (CopyOutputFiles), and every Firework that copies it from them, is
+completed, or if no child copies it at all. Usage:
+
+    wf = LaunchPad.auto_load().get_wf_by_fw_id(fw_id)
+    report = prune_workflow(wf)                   # dry run
+    report = prune_workflow(wf, dry_run=False)    # delete the files
+"""
+
+import fnmatch
+import os
+import re
+import shutil
+
+from atomate.utils.utils import get_logger
+
+from pyGWBSE.compress import compression_ext
+from pyGWBSE.tasks import CopyOutputFiles
+
+logger = get_logger(__name__)
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# large files that are only needed as inputs of the next runs
+PRUNABLE_FILES = ["WAVECAR", "WAVEDER", "CHGCAR", "CHG", "W*.tmp", "WFULL*.tmp"]
+
+
+def base_name(fname):
+    """
+    Name of a file without its compression and .relax* extensions.
+    """
+    ext = compression_ext(fname)
+    if ext:
+        fname = fname[:-len(ext)]
+    return re.sub(r"\.relax\d*$", "", fname)
+
+
+def launch_dir(fw):
+    """
+    Directory of the last completed launch of the Firework fw, or of its last
+    launch, None if it was never launched.
+    """
+    launches = [launch for launch in fw.launches if launch.state == "COMPLETED"] or fw.launches
+    return launches[-1].launch_dir if launches else None
+
+
+def get_consumers(wf):
+    """
+    Files that the Fireworks of wf copy from other run directories.
+
+    Returns:
+        {source directory: [(child Firework, [copied file patterns])]}, the
+        patterns are ["*"] for a child that copies all the files.
+    """
+    parents = wf.links.parent_links
+    consumers = {}
+    for fw in wf.fws:
+        for task in fw.tasks:
+            if not isinstance(task, CopyOutputFiles) or task.get("filesystem"):
+                continue
+            files = task.get_files_to_copy(fw.spec) or ["*"]
+            if task.get("calc_dir"):
+                sources = [task["calc_dir"]]
+            else:
+                sources = [launch_dir(wf.id_fw[fw_id]) for fw_id in parents.get(fw.fw_id, [])]
+            for source in sources:
+                if source:
+                    consumers.setdefault(os.path.abspath(source), []).append((fw, files))
+    return consumers
+
+
+def get_readers(consumers, dirname, name, seen=None):
+    """
+    Fireworks that read the file name of the directory dirname: the children
+    that copy it and, transitively, the Fireworks that copy it from them, since
+    the copies may be links to the file.
+    """
+    seen = set() if seen is None else seen
+    readers = []
+    for child, files in consumers.get(os.path.abspath(dirname), []):
+        if child.fw_id in seen or not any(fnmatch.fnmatch(name, f) for f in files):
+            continue
+        seen.add(child.fw_id)
+        readers.append(child)
+        child_dir = launch_dir(child)
+        if child_dir:
+            readers.extend(get_readers(consumers, child_dir, name, seen))
+    return readers
+
+
+def find_prunable_files(wf, patterns=None):
+    """
+    Files of the completed Fireworks of wf that match patterns (default:
+    PRUNABLE_FILES) and that no Firework still has to read, directly or through
+    a copy (see get_readers). A symlink is resolved to its target: removing the
+    link reclaims nothing, the target is pruned (and counted) in its own
+    directory. The size of a file is counted once, and only if all its hard
+    links are pruned.
+
+    Returns:
+        [dict] of the Firework, path, bytes reclaimed, link target (None if the
+        file is not a symlink) and consumers (completed Fireworks that read the
+        file) of each file.
+    """
+    patterns = patterns or PRUNABLE_FILES
+    consumers = get_consumers(wf)
+    prunable = []
+    for fw in wf.fws:
+        dirname = launch_dir(fw)
+        if fw.state != "COMPLETED" or not dirname or not os.path.isdir(dirname):
+            continue
+        for entry in os.scandir(dirname):
+            name = base_name(entry.name)
+            if not any(fnmatch.fnmatch(name, p) for p in patterns):
+                continue
+            target = os.path.realpath(entry.path) if entry.is_symlink() else None
+            if not (os.path.isfile(target) if target else entry.is_file(follow_symlinks=False)):
+                continue
+            readers = get_readers(consumers, dirname, name)
+            if all(child.state == "COMPLETED" for child in readers):
+                prunable.append({"fw_id": fw.fw_id, "fw_name": fw.name, "path": entry.path, "bytes": 0,
+                                 "target": target, "consumers": [child.fw_id for child in readers]})
+    # the space of a file is only reclaimed when all its hard links are pruned
+    links = {}
+    for f in prunable:
+        if f["target"] is None:
+            st = os.stat(f["path"], follow_symlinks=False)
+            links.setdefault((st.st_dev, st.st_ino), (st, []))[1].append(f)
+    for st, files in links.values():
+        if len(files) >= st.st_nlink:
+            files[0]["bytes"] = st.st_size
+    return prunable
+
+
+def prune_workflow(wf, dry_run=True, archive_dir=None, patterns=None):
+    """
+    Delete, or move to archive_dir, the large intermediate files of the workflow
+    wf that no Firework will read anymore (see find_prunable_files).
+
+    Args:
+        wf (Workflow): workflow, with the states and launches of its Fireworks,
+            e.g. from LaunchPad.get_wf_by_fw_id.
+        dry_run (bool): only report the files and the space that would be
+            reclaimed.
+        archive_dir (str): the files are moved to archive_dir/<fw_name>-<fw_id>
+            instead of being deleted.
+        patterns ([str]): glob patterns of the files that may be pruned, default:
+            PRUNABLE_FILES.
+
+    Returns:
+        dict with the action, the files and the number of bytes reclaimed.
+    """
+    files = find_prunable_files(wf, patterns)
+    action = "dry_run" if dry_run else ("archive" if archive_dir else "delete")
+    for f in files:
+        logger.info("{}: {} ({} bytes)".format(action, f["path"], f["bytes"]))
+        if dry_run:
+            continue
+        if archive_dir:
+            dest = os.path.join(archive_dir, "{}-{}".format(f["fw_name"], f["fw_id"]))
+            os.makedirs(dest, exist_ok=True)
+            shutil.move(f["path"], os.path.join(dest, os.path.basename(f["path"])))
+        else:
+            os.remove(f["path"])
+    nbytes = sum(f["bytes"] for f in files)
+    logger.info("{}: {} files, {:.1f} MB".format(action, len(files), nbytes / 1e6))
+    return {"action": action, "files": files, "bytes": nbytes}
@@ -0,0 +1,1153 @@
+# coding: utf-8
+
+"""
+This module defines light-weight readers for VASP output files. The readers only
+extract the sections of an output file that a task actually needs, instead of
+building a full pymatgen object for every file.
+"""
+
+import heapq
+import os
+import re
+import warnings
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+import numpy as np
+from pymatgen.core import Lattice, Structure
+from pymatgen.electronic_structure.core import Spin
+from pymatgen.io.vasp.inputs import Incar, Kpoints
+
+from pyGWBSE.cache import cached_call, cached_reader
+from pyGWBSE.compress import COMPRESSED_EXTS, is_compressed, scan_dir, zopen
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# sections of vasprun.xml that appear before the first <calculation>
+HEADER_SECTIONS = {"incar", "parameters", "kpoints", "atominfo", "initial_structure"}
+
+# sections of vasprun.xml that appear in (or after) the <calculation> blocks
+CALC_SECTIONS = {"eigenvalues", "projected", "dielectric", "optical_transition",
+                 "ionic_steps", "final_structure"}
+
+# vasprun.xml sections needed by each task (or helper function) of pyGWBSE
+PARSE_PROFILES = {
+    "gw2db": ("incar", "parameters", "kpoints", "eigenvalues", "dielectric"),
+    "bse2db": ("incar", "parameters", "kpoints", "dielectric", "optical_transition"),
+    "rpa2db": ("incar", "parameters", "kpoints", "eigenvalues", "dielectric"),
+    "eps2db": ("kpoints", "initial_structure", "eigenvalues", "projected", "ionic_steps"),
+    "scf2db": ("incar", "parameters", "kpoints", "initial_structure", "eigenvalues", "projected",
+               "dielectric", "ionic_steps"),
+    "read_epsilon": ("ionic_steps",),
+    "read_vac_level": ("initial_structure",),
+    "band_properties": ("eigenvalues",),
+    "read_vasp": ("kpoints", "eigenvalues"),
+    "incar": ("incar",),
+}
+
+
+class LazyVasprun:
+    """
+    Section-selective reader for vasprun.xml (optionally compressed).
+
+    The file is streamed with ElementTree.iterparse when one of the requested
+    attributes is first accessed. Only the requested sections are converted to
+    python objects; everything else (DOS, projections, ionic steps, ...) is
+    discarded as soon as it has been read, and the file is not read beyond the
+    header when only header sections are requested.
+
+    Args:
+        filename (str): path to vasprun.xml, vasprun.xml.gz, ...
+        profile (str): name of an entry of PARSE_PROFILES.
+        sections ([str]): sections to parse, in addition to those of the profile.
+        occu_tol (float): occupation tolerance used to find the band edges.
+        exception_on_bad_xml (bool): if False, a truncated or malformed file only
+            raises a warning and the sections read so far are kept.
+        max_transitions (int): keep only the optical transitions with the largest
+            oscillator strengths.
+        transition_energy_cutoff (float): keep only the optical transitions below
+            this energy (eV).
+        projection_groups (dict): {name: [site indices]} of the atom groups the
+            projections are reduced to, default: one group per species.
+        full_projections (bool): also keep the full (nkpt, nband, nion, norb)
+            projections in projected_eigenvalues, otherwise only the projections
+            reduced to the atom groups and l channels are kept in projections.
+    """
+
+    def __init__(self, filename, profile=None, sections=None, occu_tol=1e-8, exception_on_bad_xml=True,
+                 max_transitions=None, transition_energy_cutoff=None, projection_groups=None,
+                 full_projections=False):
+        self.filename = filename
+        self.occu_tol = occu_tol
+        self.exception_on_bad_xml = exception_on_bad_xml
+        self.max_transitions = max_transitions
+        self.transition_energy_cutoff = transition_energy_cutoff
+        self.projection_groups = projection_groups
+        self.full_projections = full_projections
+        requested = set(PARSE_PROFILES[profile]) if profile else set()
+        requested.update(sections or [])
+        unknown = requested - HEADER_SECTIONS - CALC_SECTIONS
+        if unknown:
+            raise ValueError("Unknown vasprun.xml sections: {}".format(sorted(unknown)))
+        if requested & {"initial_structure", "final_structure", "projected"}:
+            requested.add("atominfo")
+        self.sections = frozenset(requested)
+        self.parsed = False
+        self._data = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in SECTION_ATTRIBUTES:
+            raise AttributeError(name)
+        if SECTION_ATTRIBUTES[name] not in self.sections:
+            raise AttributeError("'{}' needs the '{}' section which was not requested for {}".format(
+                name, SECTION_ATTRIBUTES[name], self.filename))
+        if not self.parsed:
+            self._parse()
+        return self._data.get(name)
+
+    @property
+    def dielectric(self):
+        """
+        (energies, real, imag) of the density-density dielectric function.
+        """
+        return self.__getattr__("dielectric_data").get("density")
+
+    @property
+    def eigenvalues(self):
+        """
+        Eigenvalues as a pymatgen style {Spin: array(nkpt, nband, 2)} dict.
+        """
+        eigenvalue_set = self.__getattr__("eigenvalue_set")
+        return eigenvalue_set.as_dict() if eigenvalue_set is not None else None
+
+    @property
+    def eigenvalue_band_properties(self):
+        """
+        Band properties from the eigenvalues as (band gap, cbm, vbm, is_band_gap_direct).
+        Same definition as pymatgen's Vasprun.eigenvalue_band_properties.
+        """
+        return self.eigenvalue_set.band_edges(self.occu_tol)
+
+    def _is_wanted(self, elem, parent):
+        """
+        Return the section name if elem is the root of a requested section.
+        """
+        tag = elem.tag
+        ptag = parent.tag if parent is not None else None
+        name = elem.attrib.get("name")
+        if ptag == "modeling" and tag in ("incar", "parameters", "kpoints", "atominfo"):
+            return tag if tag in self.sections else None
+        if tag == "structure" and name == "initialpos":
+            return "initial_structure" if "initial_structure" in self.sections else None
+        if tag == "structure" and name == "finalpos":
+            return "final_structure" if "final_structure" in self.sections else None
+        if ptag == "calculation":
+            if tag == "eigenvalues":
+                return "eigenvalues" if "eigenvalues" in self.sections else None
+            if tag == "projected":
+                return "projected" if "projected" in self.sections else None
+            if tag == "varray" and name != "opticaltransitions":
+                return "ionic_steps" if "ionic_steps" in self.sections else None
+        if tag == "dielectricfunction":
+            return "dielectric" if "dielectric" in self.sections else None
+        if tag == "varray" and name == "opticaltransitions":
+            return "optical_transition" if "optical_transition" in self.sections else None
+        return None
+
+    def _get_groups(self):
+        """
+        [(name, site indices)] of the projection groups.
+        """
+        if self.projection_groups:
+            return [(name, sites) for name, sites in self.projection_groups.items()]
+        groups = {}
+        for i, symbol in enumerate(self._data.get("atomic_symbols") or []):
+            groups.setdefault(symbol, []).append(i)
+        return list(groups.items())
+
+    def _parse(self):
+        """
+        Read the requested sections, from the parse cache if the file was read before
+        with the same options.
+        """
+        self.parsed = True
+        params = [sorted(self.sections), self.exception_on_bad_xml, self.max_transitions,
+                  self.transition_energy_cutoff, self.projection_groups, self.full_projections]
+        self._data = cached_call(self.filename, "LazyVasprun", params, self._read)
+
+    def _read(self):
+        """
+        Stream the file once and convert the requested sections.
+        """
+        self._data = {"dielectric_data": {}, "other_dielectric": {}, "ionic_steps": []}
+        found = set()
+        header_only = not (self.sections & CALC_SECTIONS)
+        stack = []
+        wanted = None
+        transitions = TransitionFilter(self.max_transitions, self.transition_energy_cutoff)
+        projections = None
+        with zopen(self.filename, "rb") as f:
+            try:
+                for event, elem in ET.iterparse(f, events=("start", "end")):
+                    if event == "start":
+                        parent = stack[-1] if stack else None
+                        if elem.tag == "calculation" and parent is not None and parent.tag == "modeling":
+                            if header_only:
+                                break
+                            if "ionic_steps" in self.sections:
+                                self._data["ionic_steps"].append({})
+                        if wanted is None:
+                            section = self._is_wanted(elem, parent)
+                            if section:
+                                wanted = (section, len(stack))
+                            if section == "projected":
+                                projections = ProjectionReducer(self._get_groups(), self.full_projections)
+                        stack.append(elem)
+                        continue
+                    stack.pop()
+                    parent = stack[-1] if stack else None
+                    if wanted is not None:
+                        if wanted[1] != len(stack):
+                            # optical transitions are filtered row by row
+                            if wanted[0] == "optical_transition" and wanted[1] + 1 == len(stack):
+                                transitions.add(elem.text)
+                                parent.remove(elem)
+                            # projections are reduced band by band
+                            elif wanted[0] == "projected" and elem.tag == "set":
+                                projections.add(elem)
+                                parent.remove(elem)
+                            continue
+                        reducer = {"optical_transition": transitions, "projected": projections}
+                        self._convert(wanted[0], reducer.get(wanted[0], elem))
+                        found.add(wanted[0])
+                        wanted = None
+                        if header_only and self.sections <= found:
+                            break
+                    if parent is not None:
+                        parent.remove(elem)
+            except (ET.ParseError, EOFError) as exc:
+                if self.exception_on_bad_xml:
+                    raise
+                warnings.warn("{} is truncated or malformed ({}), only the sections read before "
+                              "the error are available".format(self.filename, exc))
+                # keep the transitions read before the end of a truncated BSE run
+                if wanted is not None and wanted[0] == "optical_transition":
+                    self._convert("optical_transition", transitions)
+        return self._data
+
+    def _convert(self, section, elem):
+        """
+        Convert the element of a requested section and store the result.
+        """
+        if section in ("incar", "parameters"):
+            self._data[section] = Incar(_parse_params(elem))
+        elif section == "kpoints":
+            kpoints, actual_kpoints, weights = _parse_kpoints(elem)
+            self._data.update({"kpoints": kpoints, "actual_kpoints": actual_kpoints,
+                               "actual_kpoints_weights": weights})
+        elif section == "atominfo":
+            self._data["atomic_symbols"] = _parse_atominfo(elem)
+        elif section in ("initial_structure", "final_structure"):
+            self._data[section] = _parse_structure(elem, self._data.get("atomic_symbols"))
+        elif section == "eigenvalues":
+            self._data["eigenvalue_set"] = _parse_eigen(elem)
+        elif section == "projected":
+            self._data.update({"projections": elem.as_dict(), "projection_labels": elem.names,
+                               "projection_orbitals": elem.orbitals,
+                               "projected_eigenvalues": elem.full_as_dict()})
+            return
+        elif section == "ionic_steps":
+            if not self._data["ionic_steps"]:
+                self._data["ionic_steps"].append({})
+            self._data["ionic_steps"][-1][elem.attrib.get("name")] = _parse_varray(elem)
+        elif section == "dielectric":
+            comment = elem.attrib.get("comment")
+            diel = self._data["dielectric_data"]
+            if comment is None or comment == "INVERSE MACROSCOPIC DIELECTRIC TENSOR (including " \
+                                              "local field effects in RPA (Hartree))":
+                key = "density" if "density" not in diel else "velocity"
+                diel.setdefault(key, _parse_diel(elem))
+            # VASP 6 labels the density and current (velocity) dielectric functions
+            elif comment == "density-density":
+                diel["density"] = _parse_diel(elem)
+            elif comment == "current-current":
+                diel["velocity"] = _parse_diel(elem)
+            else:
+                self._data["other_dielectric"][comment] = _parse_diel(elem)
+        elif section == "optical_transition":
+            self._data["optical_transition"] = elem.as_array()
+            return
+        elem.clear()
+
+
+class TransitionFilter:
+    """
+    Collect the (energy, oscillator strength) rows of <varray name="opticaltransitions">
+    one at a time. Rows above energy_cutoff are dropped immediately and only the
+    max_transitions rows with the largest oscillator strengths are held in memory.
+    The rows are returned in the order in which they appear in the file.
+    """
+
+    def __init__(self, max_transitions=None, energy_cutoff=None):
+        self.max_transitions = max_transitions
+        self.energy_cutoff = energy_cutoff
+        self.rows = []
+        self.nrows = 0
+
+    def add(self, text):
+        """
+        Add the text of one <v> row.
+        """
+        row = [_vasprun_float(x) for x in text.split()]
+        self.nrows += 1
+        if self.energy_cutoff is not None and row[0] > self.energy_cutoff:
+            return
+        item = (row[1], self.nrows, row)
+        if self.max_transitions is None:
+            self.rows.append(item)
+        elif len(self.rows) < self.max_transitions:
+            heapq.heappush(self.rows, item)
+        elif self.max_transitions > 0:
+            heapq.heappushpop(self.rows, item)
+
+    def as_array(self):
+        """
+        Kept rows as an array of shape (ntransitions, 2).
+        """
+        rows = [row for osc, n, row in sorted(self.rows, key=lambda item: item[1])]
+        return np.array(rows) if rows else np.zeros((0, 2))
+
+
+class ProjectionReducer:
+    """
+    Reduce the projections of <projected> one band at a time, while the block is
+    parsed. The (nion, norb) projections of each band are summed over the atoms of
+    each group and over the m components of each angular momentum l, so only
+    (ngroups, nl) numbers per band are held in memory. Groups are lists of site
+    indices; atoms that are in no group are left out.
+    The full (nion, norb) projections are kept as well when keep_full is True.
+
+    Args:
+        groups ([(str, [int])]): (name, site indices) of each group.
+        keep_full (bool): also keep the full projections.
+    """
+
+    def __init__(self, groups, keep_full=False):
+        self.names = [name for name, sites in groups]
+        self.groups = [list(sites) for name, sites in groups]
+        self.keep_full = keep_full
+        self.group_matrix = self.l_matrix = None
+        self.reduced = {}
+        self.full = {}
+        self._kpoints, self._bands = [], []
+        self._full_kpoints, self._full_bands = [], []
+
+    @property
+    def orbitals(self):
+        """
+        Names of the l channels of the reduced projections.
+        """
+        nl = self.l_matrix.shape[1] if self.l_matrix is not None else 0
+        return ["s", "p", "d", "f", "g"][:nl]
+
+    def add(self, elem):
+        """
+        Add a <set> of the projection array: a band set is reduced, k-point and spin
+        sets close the bands and k-points added since the previous one.
+        """
+        comment = elem.attrib.get("comment", "")
+        if comment.startswith("band"):
+            proj = np.array(" ".join(r.text for r in elem.findall("r")).split(), dtype=float)
+            proj = proj.reshape(len(elem), -1)
+            if self.group_matrix is None:
+                self._setup(*proj.shape)
+            self._bands.append(self.group_matrix.dot(proj).dot(self.l_matrix))
+            if self.keep_full:
+                self._full_bands.append(proj)
+        elif comment.startswith("kpoint") and self._bands:
+            self._kpoints.append(self._bands)
+            self._full_kpoints.append(self._full_bands)
+            self._bands, self._full_bands = [], []
+        elif comment.startswith("spin") and self._kpoints:
+            spin = int(comment.replace("spin", "").strip())
+            self.reduced[spin] = np.array(self._kpoints)
+            if self.keep_full:
+                self.full[spin] = np.array(self._full_kpoints)
+            self._kpoints, self._full_kpoints = [], []
+
+    def _setup(self, nion, norb):
+        """
+        Build the (ngroups, nion) group and the (norb, nl) angular momentum matrices;
+        the orbitals are ordered s, p (3), d (5), f (7) so column i has l = int(sqrt(i)).
+        """
+        self.group_matrix = np.zeros((len(self.groups), nion))
+        for i, sites in enumerate(self.groups):
+            self.group_matrix[i, sites] = 1.0
+        lvals = np.sqrt(np.arange(norb)).astype(int)
+        self.l_matrix = (lvals[:, None] == np.arange(lvals[-1] + 1)[None, :]).astype(float)
+
+    @staticmethod
+    def _by_spin(data):
+        # non-collinear runs have 4 'spin' components, keep the total only
+        if len(data) > 2:
+            return {Spin.up: data[1]}
+        return {Spin.up if k == 1 else Spin.down: v for k, v in data.items()}
+
+    def as_dict(self):
+        """
+        Reduced projections as {Spin: array(nkpt, nband, ngroups, nl)}.
+        """
+        return self._by_spin(self.reduced)
+
+    def full_as_dict(self):
+        """
+        Full projections as {Spin: array(nkpt, nband, nion, norb)}, None if they
+        were not kept.
+        """
+        return self._by_spin(self.full) if self.keep_full else None
+
+
+# attributes of LazyVasprun and the section they are read from
+SECTION_ATTRIBUTES = {
+    "incar": "incar",
+    "parameters": "parameters",
+    "kpoints": "kpoints",
+    "actual_kpoints": "kpoints",
+    "actual_kpoints_weights": "kpoints",
+    "atomic_symbols": "atominfo",
+    "initial_structure": "initial_structure",
+    "final_structure": "final_structure",
+    "eigenvalue_set": "eigenvalues",
+    "projected_eigenvalues": "projected",
+    "projections": "projected",
+    "projection_labels": "projected",
+    "projection_orbitals": "projected",
+    "ionic_steps": "ionic_steps",
+    "dielectric_data": "dielectric",
+    "other_dielectric": "dielectric",
+    "optical_transition": "optical_transition",
+}
+
+
+def _vasprun_float(f):
+    """
+    Convert a vasprun.xml number, VASP writes '*****' on overflow.
+    """
+    try:
+        return float(f)
+    except ValueError:
+        if f.strip() == "*" * len(f.strip()):
+            return np.nan
+        raise
+
+
+def _parse_value(ptype, val):
+    """
+    Convert the text of an <i> element.
+    """
+    if ptype == "logical":
+        return val == "T"
+    if ptype == "int":
+        return int(val)
+    if ptype == "string":
+        return val.strip()
+    return _vasprun_float(val)
+
+
+def _parse_vector(ptype, val):
+    """
+    Convert the text of a <v> element, None if VASP wrote an overflowed value.
+    """
+    try:
+        if ptype == "logical":
+            return [i == "T" for i in val.split()]
+        if ptype == "int":
+            return [int(i) for i in val.split()]
+        if ptype == "string":
+            return val.split()
+        return [float(i) for i in val.split()]
+    except ValueError:
+        return None
+
+
+def _parse_params(elem):
+    """
+    Parse <incar> or <parameters> into a flat dictionary.
+    """
+    params = {}
+    for c in elem:
+        name = c.attrib.get("name")
+        if c.tag not in ("i", "v"):
+            p = _parse_params(c)
+            if name == "response functions":
+                p = {k: v for k, v in p.items() if k not in params}
+            params.update(p)
+        else:
+            ptype = c.attrib.get("type")
+            val = c.text.strip() if c.text else ""
+            if c.tag == "i":
+                params[name] = _parse_value(ptype, val)
+            else:
+                params[name] = _parse_vector(ptype, val)
+    return params
+
+
+def _parse_varray(elem):
+    """
+    Parse a <varray> (or a <set> of <r>) into a list of lists.
+    """
+    if elem.get("type") == "logical":
+        return [[i == "T" for i in v.text.split()] for v in elem]
+    return [[_vasprun_float(i) for i in v.text.split()] for v in elem]
+
+
+def _parse_kpoints(elem):
+    """
+    Parse <kpoints> into (Kpoints, actual k-points, k-point weights).
+    """
+    e = elem.find("generation")
+    if e is None:
+        e = elem
+    k = Kpoints("Kpoints from vasprun.xml")
+    k.style = Kpoints.supported_modes.from_string(e.attrib.get("param", "Reciprocal"))
+    for v in e.findall("v"):
+        name = v.attrib.get("name")
+        toks = v.text.split()
+        if name == "divisions":
+            k.kpts = [[int(i) for i in toks]]
+        elif name == "usershift":
+            k.kpts_shift = [float(i) for i in toks]
+        elif name in {"genvec1", "genvec2", "genvec3", "shift"}:
+            setattr(k, name, [float(i) for i in toks])
+    actual_kpoints = []
+    weights = []
+    for va in elem.findall("varray"):
+        name = va.attrib["name"]
+        if name == "kpointlist":
+            actual_kpoints = _parse_varray(va)
+        elif name == "weights":
+            weights = [i[0] for i in _parse_varray(va)]
+    if k.style == Kpoints.supported_modes.Reciprocal:
+        k = Kpoints(comment="Kpoints from vasprun.xml", style=Kpoints.supported_modes.Reciprocal,
+                    num_kpts=len(actual_kpoints), kpts=actual_kpoints, kpts_weights=weights)
+    return k, actual_kpoints, weights
+
+
+def _parse_atominfo(elem):
+    """
+    Parse the atomic symbols from <atominfo>.
+    """
+    symbols = []
+    for a in elem.findall("array"):
+        if a.attrib.get("name") == "atoms":
+            for rc in a.find("set"):
+                sym = rc.find("c").text.strip()
+                # VASP truncates some element names in vasprun.xml
+                symbols.append({"X": "Xe", "r": "Zr"}.get(sym, sym))
+    return symbols
+
+
+def _parse_structure(elem, symbols):
+    """
+    Parse a <structure> element.
+    """
+    latt = _parse_varray(elem.find("crystal").find("varray"))
+    pos = _parse_varray(elem.find("varray"))
+    return Structure(Lattice(latt), symbols, pos)
+
+
+def _parse_eigen(elem):
+    """
+    Parse <eigenvalues> into an EigenvalueSet.
+    """
+    spins = elem.find("array").find("set").findall("set")
+    return EigenvalueSet([[_parse_varray(ss) for ss in s.findall("set")] for s in spins])
+
+
+def _parse_diel(elem):
+    """
+    Parse <dielectricfunction> into (energies, real, imag).
+    """
+    imag = [[_vasprun_float(x) for x in r.text.split()]
+            for r in elem.find("imag").find("array").find("set").findall("r")]
+    real = [[_vasprun_float(x) for x in r.text.split()]
+            for r in elem.find("real").find("array").find("set").findall("r")]
+    return [e[0] for e in imag], [e[1:] for e in real], [e[1:] for e in imag]
+
+
+class OutcarTail:
+    """
+    Reader for the final section of an OUTCAR.
+
+    The file is read backwards from its end, in blocks of block_size bytes, until
+    the timing and memory block ("General timing and accounting ...") and the
+    requested patterns have been found. The cost of reading therefore depends on
+    the size of the requested data and not on the size of the OUTCAR. Compressed
+    files can not be read backwards and are streamed forward instead, keeping
+    only the last matches.
+
+    Args:
+        filename (str): path to OUTCAR (optionally compressed).
+        patterns (dict): {name: regex} of additional fields; the last match of each
+            pattern is stored in data[name] as a tuple of the matched groups.
+        block_size (int): number of bytes read per backward step.
+        max_bytes (int): stop reading backwards after this many bytes, even if not
+            everything has been found.
+
+    Attributes:
+        run_stats (dict): same content as pymatgen's Outcar.run_stats.
+        data (dict): matches of the additional patterns.
+    """
+
+    TIMING_HEADER = "General timing and accounting informations for this job"
+
+    def __init__(self, filename, patterns=None, block_size=1 << 16, max_bytes=None):
+        self.filename = filename
+        self.patterns = {k: re.compile(v) for k, v in (patterns or {}).items()}
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        params = [sorted((patterns or {}).items()), max_bytes]
+        self.run_stats, self.data = cached_call(filename, "OutcarTail", params, self._read)
+
+    def _read(self):
+        """
+        Read the OUTCAR, returns (run_stats, data).
+        """
+        self.run_stats = {}
+        self.data = {}
+        if is_compressed(self.filename):
+            self._read_forward()
+        else:
+            self._read_backward()
+        self.run_stats["cores"] = self._read_cores()
+        return self.run_stats, self.data
+
+    def _read_backward(self):
+        """
+        Parse the lines from the end of the file until everything is found.
+        """
+        timing_done = False
+        for line in reverse_readlines(self.filename, self.block_size, self.max_bytes):
+            if not timing_done:
+                if self.TIMING_HEADER in line:
+                    timing_done = True
+                elif _TIME_PATT.search(line):
+                    self._add_run_stat(line)
+                    continue
+            for name, patt in self.patterns.items():
+                if name not in self.data:
+                    m = patt.search(line)
+                    if m:
+                        self.data[name] = m.groups()
+            if timing_done and len(self.data) == len(self.patterns):
+                break
+
+    def _read_forward(self):
+        """
+        Stream the whole (compressed) file and keep the last matches.
+        """
+        in_timing = False
+        with zopen(self.filename, "rt") as f:
+            for line in f:
+                if self.TIMING_HEADER in line:
+                    in_timing = True
+                    self.run_stats = {}
+                elif in_timing and _TIME_PATT.search(line):
+                    self._add_run_stat(line)
+                    continue
+                for name, patt in self.patterns.items():
+                    m = patt.search(line)
+                    if m:
+                        self.data[name] = m.groups()
+
+    def _add_run_stat(self, line):
+        tok = line.strip().split(":")
+        try:
+            self.run_stats[tok[0].strip()] = float(tok[1].strip())
+        except ValueError:
+            # VASP may print 'Average memory used (kb):   N/A'
+            self.run_stats[tok[0].strip()] = None
+
+    def _read_cores(self):
+        """
+        Number of cores from the beginning of the OUTCAR.
+        """
+        with zopen(self.filename, "rt") as f:
+            for line in f:
+                if "serial" in line:
+                    return 1
+                if "running" in line:
+                    toks = line.split()
+                    return int(toks[2]) if toks[1] == "on" else int(toks[1])
+        return None
+
+
+_TIME_PATT = re.compile(r"\((sec|kb)\)")
+
+
+def reverse_readlines(filename, block_size=1 << 16, max_bytes=None):
+    """
+    Generate the lines of an (uncompressed) text file from the last to the first,
+    reading block_size bytes at a time from the end of the file.
+    """
+    with open(filename, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        end = pos
+        tail = b""
+        while pos > 0:
+            if max_bytes is not None and end - pos >= max_bytes:
+                return
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            # the first piece may be an incomplete line, keep it for the next block
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode("utf-8", "replace")
+        yield tail.decode("utf-8", "replace")
+
+
+# values of ALGO for which the OUTCAR contains a table of QP energies
+GW_ALGOS = {"GW", "GW0", "SCGW", "SCGW0", "EVGW", "EVGW0", "QPGW", "QPGW0", "G0W0"}
+
+
+class EigenvalueSet:
+    """
+    Eigenvalues and occupations of all the spins, k-points and bands of a run, stored
+    in a single array of shape (nspin, nkpt, nband, 2) of (energy, occupation).
+    Band edges, gaps and the BSE band window are computed on the whole array at once.
+
+    Args:
+        data (array): (nspin, nkpt, nband, 2) array of (energy, occupation).
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        data = np.asarray(data, dtype=float)
+        if data.ndim != 4 or data.shape[-1] != 2 or data.shape[0] not in (1, 2):
+            raise ValueError("Eigenvalues must have the shape (nspin, nkpt, nband, 2), got {}".format(data.shape))
+        self.data = data
+
+    @classmethod
+    def from_dict(cls, eigenvalues):
+        """
+        Build the set from a pymatgen style {Spin: array(nkpt, nband, 2)} dict, the keys
+        may also be the strings '1' and '-1' of a document read back from the database.
+        An EigenvalueSet is returned unchanged.
+        """
+        if isinstance(eigenvalues, cls):
+            return eigenvalues
+        spins = {int(spin): eigs for spin, eigs in eigenvalues.items()}
+        return cls([spins[spin] for spin in (1, -1) if spin in spins])
+
+    def as_dict(self):
+        """
+        {Spin: array(nkpt, nband, 2)}, the format of pymatgen's Vasprun.eigenvalues
+        that is stored in the database. The arrays are views of self.data.
+        """
+        return dict(zip((Spin.up, Spin.down), self.data))
+
+    @property
+    def energies(self):
+        return self.data[..., 0]
+
+    @property
+    def occupations(self):
+        return self.data[..., 1]
+
+    @property
+    def nspin(self):
+        return self.data.shape[0]
+
+    @property
+    def nkpt(self):
+        return self.data.shape[1]
+
+    @property
+    def nband(self):
+        return self.data.shape[2]
+
+    def band_edges(self, occu_tol=1e-8):
+        """
+        Same definition as pymatgen's Vasprun.eigenvalue_band_properties.
+
+        Args:
+            occu_tol (float): bands with occupation above occu_tol are occupied.
+
+        Returns:
+            (band gap, cbm, vbm, is_band_gap_direct)
+        """
+        energies = self.energies
+        occupied = self.occupations > occu_tol
+        vbm, cbm = -float("inf"), float("inf")
+        vbm_kpoint = cbm_kpoint = None
+        if occupied.any():
+            ind = np.unravel_index(np.argmax(np.where(occupied, energies, -np.inf)), energies.shape)
+            vbm, vbm_kpoint = float(energies[ind]), int(ind[1])
+        if not occupied.all():
+            ind = np.unravel_index(np.argmin(np.where(occupied, np.inf, energies)), energies.shape)
+            cbm, cbm_kpoint = float(energies[ind]), int(ind[1])
+        return max(cbm - vbm, 0), cbm, vbm, bool(vbm_kpoint == cbm_kpoint)
+
+    def gaps(self, occu_tol=1e-5):
+        """
+        Indirect and direct band gaps. The direct gap is the smallest difference
+        between the lowest empty and the highest occupied band at the same k-point
+        and for the same spin; k-points (and spins) without an occupied or without an
+        empty band are skipped.
+
+        Args:
+            occu_tol (float): bands with occupation above occu_tol are occupied.
+
+        Returns:
+            (indirect gap, direct gap)
+        """
+        gap, cbm, vbm, is_direct = self.band_edges(occu_tol)
+        energies = self.energies
+        occupied = self.occupations > occu_tol
+        kvbm = np.where(occupied, energies, -np.inf).max(axis=2)
+        kcbm = np.where(occupied, np.inf, energies).min(axis=2)
+        kgap = kcbm - kvbm
+        kgap = kgap[np.isfinite(kgap)]
+        dgap = float(kgap.min()) if kgap.size else float("inf")
+        return gap, dgap
+
+    def band_window(self, vbm, cbm, enwin, occu_tol=1e-5):
+        """
+        Number of occupied and empty bands within enwin of the band edges, i.e. the
+        NBANDSO and NBANDSV of a BSE calculation. Each spin uses its own occupations.
+
+        Args:
+            vbm (float): valence band maximum.
+            cbm (float): conduction band minimum.
+            enwin (float): energy window (eV) below the vbm and above the cbm.
+            occu_tol (float): tolerance on the occupation of filled and empty bands.
+
+        Returns:
+            (nbandso, nbandsv)
+        """
+        energies = self.energies
+        occ = self.occupations
+        valence = (np.abs(occ - 1.0) < occu_tol) & (vbm - energies <= enwin)
+        conduction = (occ < occu_tol) & (energies - cbm <= enwin)
+        if not valence.any() or not conduction.any():
+            raise ValueError("No occupied or no empty band within {} eV of the band edges".format(enwin))
+        vbands = np.nonzero(valence.any(axis=(0, 1)))[0]
+        cbands = np.nonzero(conduction.any(axis=(0, 1)))[0]
+        return int(vbands[-1] - vbands[0] + 1), int(cbands[-1] - cbands[0] + 1)
+
+
+@cached_reader
+def read_eigenval(fname):
+    """
+    Read eigenvalues and occupations from an EIGENVAL file (VASP >= 5.4).
+
+    Returns:
+        EigenvalueSet, or None if the file has no occupations.
+    """
+    with zopen(fname, "rt") as f:
+        ispin = int(f.readline().split()[3])
+        for i in range(4):
+            f.readline()
+        nelect, nkpt, nband = [int(x) for x in f.readline().split()]
+        data = np.array(f.read().split(), dtype=float)
+    ncol = 1 + 2 * ispin
+    if data.size != nkpt * (4 + nband * ncol):
+        return None
+    bands = data.reshape(nkpt, -1)[:, 4:].reshape(nkpt, nband, ncol)
+    # columns: band index, energies of each spin, occupations of each spin
+    energies = bands[:, :, 1:1 + ispin]
+    occupations = bands[:, :, 1 + ispin:]
+    return EigenvalueSet(np.stack([energies, occupations], axis=-1).transpose(2, 0, 1, 3))
+
+
+@cached_reader
+def read_qp_eigenvalues(fname, block_size=1 << 16):
+    """
+    Read the QP energies and occupations of the last 'QP shifts' table of a GW
+    OUTCAR. Only the end of the file, down to the start of that table, is read.
+    Occupations are normalized to 1 for a filled band.
+
+    Returns:
+        EigenvalueSet with nbandsgw bands, or None if no QP table was found.
+    """
+    block = []
+    if is_compressed(fname):
+        with zopen(fname, "rt") as f:
+            for line in f:
+                if line.strip().startswith("QP shifts"):
+                    block = []
+                block.append(line)
+    else:
+        for line in reverse_readlines(fname, block_size):
+            block.append(line)
+            if line.strip().startswith("QP shifts"):
+                break
+        block.reverse()
+    if not block or not block[0].strip().startswith("QP shifts"):
+        return None
+    spins = defaultdict(list)
+    spin = Spin.up
+    qp_col = occ_col = None
+    for line in block[1:]:
+        toks = line.split()
+        if not toks:
+            continue
+        if toks[0] == "spin" and toks[1] == "component":
+            spin = Spin.up if toks[2] == "1" else Spin.down
+        elif toks[0] == "k-point":
+            spins[spin].append([])
+        elif toks[0] == "band" and "QP-energies" in toks:
+            # 'band No.' is two words in the header but one column in the table
+            qp_col = toks.index("QP-energies") - 1
+            occ_col = toks.index("occupation") - 1
+        elif qp_col is not None and toks[0].isdigit() and len(toks) > occ_col and spins[spin]:
+            spins[spin][-1].append([float(toks[qp_col]), float(toks[occ_col])])
+        elif qp_col is not None and any(spins[spin]):
+            # end of the table
+            break
+    if not any(spins[Spin.up]):
+        return None
+    eigenvalues = EigenvalueSet([spins[spin] for spin in (Spin.up, Spin.down) if spin in spins])
+    if eigenvalues.nspin == 1:
+        # non spin-polarized runs have 2 electrons per filled band
+        occ = eigenvalues.occupations
+        occ /= 2.0 if occ.max() > 1.0 else 1.0
+    return eigenvalues
+
+
+def read_band_properties(directory=".", vasprun_fname=None, sources=("OUTCAR", "EIGENVAL", "vasprun.xml"),
+                         occu_tol=1e-8):
+    """
+    Get the eigenvalues and band edges of the last VASP run in a directory from the
+    cheapest available source. The QP table of the OUTCAR is used only for GW runs
+    and EIGENVAL only for the other runs (ALGO is read from the INCAR); vasprun.xml,
+    streaming only its eigenvalue block, is the fallback.
+
+    Args:
+        directory (str): run directory.
+        vasprun_fname (str): vasprun.xml to fall back to, default: directory/vasprun.xml.
+        sources ((str)): sources that may be used.
+        occu_tol (float): occupation tolerance used to find the band edges.
+
+    Returns:
+        (EigenvalueSet, (band gap, cbm, vbm, is_band_gap_direct))
+    """
+    eigenvalues = None
+    incar_fname = find_file(directory, "INCAR")
+    algo = ""
+    if incar_fname:
+        with zopen(incar_fname, "rt") as f:
+            algo = str(Incar.from_string(f.read()).get("ALGO", ""))
+    is_gw = algo.upper() in GW_ALGOS
+    if is_gw and "OUTCAR" in sources:
+        fname = find_file(directory, "OUTCAR")
+        if fname:
+            eigenvalues = read_qp_eigenvalues(fname)
+    elif not is_gw and "EIGENVAL" in sources:
+        fname = find_file(directory, "EIGENVAL")
+        if fname:
+            eigenvalues = read_eigenval(fname)
+    if eigenvalues is None:
+        fname = vasprun_fname or find_file(directory, "vasprun.xml") or os.path.join(directory, "vasprun.xml")
+        eigenvalues = LazyVasprun(fname, profile="band_properties").eigenvalue_set
+    return eigenvalues, eigenvalues.band_edges(occu_tol)
+
+
+def find_file(directory, name, required=False):
+    """
+    Path of the newest of directory/name, its .relax* versions and their
+    compressed versions. A plain file is preferred to a compressed one with the
+    same modification time, as it is left in place until its compression is
+    complete. If none exists, returns None or raises FileNotFoundError if required.
+    """
+    pattern = re.compile(r"{}(\.relax\d+)?({})?$".format(
+        re.escape(name), "|".join(re.escape(ext) for ext in COMPRESSED_EXTS)), re.IGNORECASE)
+    found = []
+    for fname, mtime_ns in scan_dir(directory):
+        if fname.startswith(name) and pattern.match(fname):
+            found.append((mtime_ns, not is_compressed(fname), fname))
+    if not found:
+        if required:
+            raise FileNotFoundError("Cannot find {} in {}".format(name, os.path.abspath(directory or ".")))
+        return None
+    return os.path.join(directory, max(found)[2])
+
+
+def load_numbers(fname):
+    """
+    Load all the whitespace separated numbers of a text file into a 1D float array.
+    Plain files are parsed by numpy's C text reader while streaming from disk,
+    without building the file content (or a list of tokens) in memory.
+    """
+    if is_compressed(fname):
+        with zopen(fname, "rb") as f:
+            return np.array(f.read().split(), dtype=float)
+    return np.fromfile(fname, sep=" ")
+
+
+@cached_reader
+def read_wannier_bands(fname_band, fname_kpt):
+    """
+    Read the band structure interpolated by Wannier90.
+
+    Args:
+        fname_band (str): wannier90_band.dat
+        fname_kpt (str): wannier90_band.kpt
+
+    Returns:
+        (k-path distances, energies), both arrays of shape (nband, nkpt)
+    """
+    data = load_numbers(fname_band)
+    nkpt = read_wannier_nkpt(fname_kpt)
+    nband = int(data.size / 2 / nkpt)
+    return data[0::2].reshape(nband, nkpt), data[1::2].reshape(nband, nkpt)
+
+
+@cached_reader
+def read_wannier_nkpt(fname_kpt):
+    """
+    Number of k-points of wannier90_band.kpt.
+    """
+    with zopen(fname_kpt, "rt") as f:
+        return int(f.readline().split()[0])
+
+
+_XTICS_PATT = re.compile(r"set xtics")
+
+
+@cached_reader
+def read_wannier_xtics(fname_gnu):
+    """
+    Labels and positions of the special k-points from wannier90_band.gnu.
+    Wannier90 writes them as: set xtics ("G  "  0.00000,"X  "  1.00000, ...)
+    """
+    labels = []
+    coords = []
+    with zopen(fname_gnu, "rt") as f:
+        for line in f:
+            if _XTICS_PATT.search(line):
+                pieces = line.split('"')
+                labels.extend(pieces[1::2])
+                # each position is written as ' ' + F8.5 followed by ',' or ')'
+                coords.extend(float(p[:9]) for p in pieces[2::2])
+    return labels, coords
+
+
+@cached_reader
+def read_wannier_hr(fname_hr):
+    """
+    Read the real-space Hamiltonian wannier90_hr.dat.
+
+    Returns:
+        (degeneracies (nrpts,), lattice vectors (nrpts, 3), H(R) (nrpts, num_wann, num_wann))
+    """
+    with zopen(fname_hr, "rb") as f:
+        f.readline()
+        num_wann = int(f.readline())
+        nrpts = int(f.readline())
+        if is_compressed(fname_hr):
+            data = np.array(f.read().split(), dtype=float)
+        else:
+            data = np.fromfile(f, sep=" ")
+    ndegen = data[:nrpts].astype(int)
+    rows = data[nrpts:].reshape(nrpts, num_wann, num_wann, 7)
+    irvec = rows[:, 0, 0, :3].astype(int)
+    # the file is written with the row index m running fastest
+    ham = (rows[..., 5] + 1j * rows[..., 6]).transpose(0, 2, 1)
+    return ndegen, irvec, ham
+
+
+_SUMO_MASS_PATT = re.compile(r"m_([he]):")
+
+
+@cached_reader
+def read_sumo_bandstats(fname):
+    """
+    Read the hole and electron effective masses from sumo-bandstats.log.
+
+    Returns:
+        (hole masses, electron masses) as {'mass<n>: <band>, <from>, <to>': mass}
+    """
+    res = {"h": {}, "e": {}}
+    with zopen(fname, "rt") as f:
+        for line in f:
+            m = _SUMO_MASS_PATT.search(line)
+            if not m:
+                continue
+            toks = line.split()
+            mass = float(toks[1])
+            ibnd = int(toks[4])
+            # the start of the path has no label if it is not a special k-point
+            if toks.index('->') == 10:
+                dir1, dir2 = toks[9], toks[14]
+            else:
+                dir1, dir2 = 'Intermediate', toks[13]
+            d = res[m.group(1)]
+            d['mass' + str(len(d) + 1) + ': ' + str(ibnd) + ', ' + dir1 + ', ' + dir2] = mass
+    return res["h"], res["e"]
+
+
+@cached_reader
+def read_locpot_planar_average(fname):
+    """
+    Planar average of a LOCPOT (or any CHGCAR-like file) along the c axis, computed
+    while the volumetric data is streamed one ab-plane at a time. Only one plane
+    of the grid is held in memory.
+
+    Returns:
+        (positions of the planes along c (Angstrom), planar average)
+    """
+    with zopen(fname, "rb") as f:
+        f.readline()
+        scale = float(f.readline().split()[0])
+        latt = np.array([[float(x) for x in f.readline().split()[:3]] for i in range(3)])
+        if scale < 0:
+            # a negative scale factor is the volume of the cell
+            scale = (-scale / abs(np.linalg.det(latt))) ** (1 / 3)
+        toks = f.readline().split()
+        if not all(t.isdigit() for t in toks):
+            # VASP 5 format, this line has the element symbols
+            toks = f.readline().split()
+        nions = sum(int(t) for t in toks)
+        line = f.readline().strip()
+        if line[:1] in (b"s", b"S"):
+            line = f.readline()
+        for i in range(nions):
+            f.readline()
+        line = f.readline()
+        while not line.strip():
+            line = f.readline()
+        ngx, ngy, ngz = [int(x) for x in line.split()]
+        npts = ngx * ngy
+        average = np.empty(ngz)
+        if is_compressed(fname):
+            buf = []
+            for iz in range(ngz):
+                while len(buf) < npts:
+                    buf.extend(f.readline().split())
+                average[iz] = np.array(buf[:npts], dtype=float).sum() / npts
+                del buf[:npts]
+        else:
+            for iz in range(ngz):
+                average[iz] = np.fromfile(f, sep=" ", count=npts).sum() / npts
+    latt_c = scale * np.linalg.norm(latt[2])
+    return np.arange(ngz) / ngz * latt_c, average
+
+
+def find_vacuum_plane(zarr, site_z, latt_c):
+    """
+    Index of the plane of zarr that is the farthest (along z, with periodic
+    boundary conditions) from all the sites.
+
+    Args:
+        zarr (array): positions of the planes along z.
+        site_z (array): cartesian z coordinates of the sites.
+        latt_c (float): length of the cell along z.
+    """
+    dist = np.abs(np.asarray(zarr)[:, None] - np.asarray(site_z)[None, :]) % latt_c
+    dist = np.minimum(dist, latt_c - dist)
+    return int(np.argmax(dist.min(axis=1)))
@@ -0,0 +1,218 @@
+# coding: utf-8
+
+"""
+This module defines the access to the results written by pyGWBSE.out2db. The
+accessors fetch the documents of many materials with a single cursor and only
+the fields they need (server-side projection); the large arrays (energies,
+projections, dielectric functions, ...) are fetched on first access and returned
+as numpy arrays, whether they are stored as lists or as binary arrays
+(see pyGWBSE.arrays). Usage:
+
+    results = Results.from_db_file("db.json")
+    gaps = results.gaps(["mp-149", "mp-661"])     # {material_id: ResultDoc}
+    gaps["mp-149"]["indirect_gap"]
+    bands = results.qp_bands("mp-149")            # one ResultDoc
+    bands["qp_energies"]["1"]                     # fetched now, ndarray (nkpt, nband, 2)
+
+The queries use the structured fields of the results (stage, iteration, ifconv,
+see pyGWBSE.database.query_fields); older documents get them with
+pyGWBSE.database.backfill_query_fields.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+from pyGWBSE.arrays import ARRAY_FIELDS, unpack_arrays
+from pyGWBSE.database import get_db
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# fields of every result returned by the accessors
+BASE_FIELDS = ["material_id", "formula_pretty", "task_label", "job_tag", "stage", "iteration", "workflow_id"]
+
+# collection and stage of the spectra of each kind
+SPECTRA = {"BSE": ("BSE_Results", "BSE"), "RPA": ("RPA_Results", "SCF"), "GW": ("QP_Results", "scGW")}
+
+
+class ResultDoc(Mapping):
+    """
+    Read-only result document. The fields that were not fetched with the
+    document (e.g. the large arrays) are fetched from the database on first
+    access; the arrays are returned as numpy arrays ({spin: array} for the
+    fields per spin).
+    """
+
+    def __init__(self, collection, doc):
+        self._collection = collection
+        self._doc = dict(doc)
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+        if key not in self._doc:
+            self.fetch([key])
+            if key not in self._doc:
+                raise KeyError(key)
+        value = self._doc[key]
+        if key in ARRAY_FIELDS:
+            value = _to_numpy(unpack_arrays(value, self._collection.database))
+        self._decoded[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._doc)
+
+    def __len__(self):
+        return len(self._doc)
+
+    def __repr__(self):
+        return "ResultDoc({}, {})".format(self._collection.name, sorted(self._doc))
+
+    def fetch(self, fields):
+        """
+        Fetch the fields (e.g. several arrays at once) that are not loaded yet.
+        """
+        fields = [f for f in fields if f not in self._doc]
+        if fields:
+            doc = self._collection.find_one({"_id": self._doc["_id"]}, {f: 1 for f in fields}) or {}
+            self._doc.update(doc)
+        return self
+
+
+class Results:
+    """
+    Accessors of the results of a pyGWBSE database. The methods take a material
+    id, and return a ResultDoc (None if there is no result), or a list of
+    material ids, and return {material_id: ResultDoc} fetched with one cursor.
+    The arrays are fetched lazily, unless they are listed in arrays: they are
+    then fetched in the same cursor, which is faster for many materials.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: pymongo Database, e.g. VaspCalcDb.from_db_file(db_file).db.
+        """
+        self.db = db
+
+    @classmethod
+    def from_db_file(cls, db_file, admin=True):
+        """
+        Results of the database of db_file; admin=False reads with the
+        read-only user of db_file.
+        """
+        return cls(get_db(db_file, admin=admin).db)
+
+    def find(self, collection, material_ids=None, query=None, fields=None, arrays=None, sort=None):
+        """
+        Result documents of a collection with a single cursor.
+
+        Args:
+            collection (str): result collection.
+            material_ids ([str]): materials, default: all of them.
+            query (dict): additional filter, e.g. {"stage": "scGW"}.
+            fields ([str]): fields fetched with the documents, in addition to
+                BASE_FIELDS; default: all the fields.
+            arrays ([str]): arrays fetched with the documents.
+            sort ([(str, int)]): sort of the cursor.
+
+        Returns:
+            [ResultDoc]
+        """
+        query = dict(query or {})
+        if material_ids is not None:
+            query["material_id"] = {"$in": list(material_ids)}
+        projection = None
+        if fields is not None:
+            projection = {f: 1 for f in BASE_FIELDS + list(fields) + list(arrays or [])}
+        coll = self.db[collection]
+        return [ResultDoc(coll, doc) for doc in coll.find(query, projection, sort=sort)]
+
+    def gaps(self, material_ids, job_tag=None):
+        """
+        Direct and indirect QP gaps, VBM and CBM of the converged GW results.
+        """
+        return self._latest("QP_Results", material_ids, self._gw_query(job_tag),
+                            ["direct_gap", "indirect_gap", "vbm", "cbm", "ifconv"])
+
+    def qp_bands(self, material_ids, job_tag=None, arrays=None):
+        """
+        QP energies ("qp_energies", {spin: array(nkpt, nband, 2)}) of the
+        converged GW results, with their VBM, CBM and k-points.
+        """
+        return self._latest("QP_Results", material_ids, self._gw_query(job_tag),
+                            ["vbm", "cbm", "ifconv", "kpoints"], arrays)
+
+    def spectra(self, material_ids, kind="BSE", job_tag=None, arrays=None):
+        """
+        Dielectric functions ("frequency", "epsilon_1", "epsilon_2") of the BSE,
+        RPA (SCF run) or GW (converged GW run) results; the BSE results also have
+        the optical transitions and the QP gaps.
+        """
+        collection, stage = SPECTRA[kind]
+        query = self._gw_query(job_tag) if kind == "GW" else {"stage": stage}
+        if job_tag and kind != "GW":
+            query["job_tag"] = job_tag
+        fields = ["direct_gap", "indirect_gap"] + (["optical_transition"] if kind == "BSE" else [])
+        return self._latest(collection, material_ids, query, fields, arrays)
+
+    def pdos_inputs(self, material_ids, arrays=None):
+        """
+        Inputs of a PDOS of the SCF results: the projections
+        ("projected_eigs_reduced", {spin: array(nkpt, nband, ngroups, nl)}, with
+        "projection_groups" and "projection_orbitals", and with full_projections
+        "projected_eigs", {spin: array(nkpt, nband, nion, norb)}), the KS
+        energies ("ks_energies"), the k-point weights and the VBM.
+        """
+        return self._latest("EPS_Results", material_ids, None,
+                            ["vbm", "cbm", "kpoint_weights", "projection_groups", "projection_orbitals"], arrays)
+
+    def convergence(self, material_id, job_tag=None):
+        """
+        Convergence history of the GW parameters of a material: [ResultDoc] of
+        the iterations, with their GW parameters, gaps and convergence flag.
+        """
+        query = {"stage": "Convergence"}
+        if job_tag:
+            query["job_tag"] = job_tag
+        return self.find("QP_Results", [material_id], query,
+                         ["gw_params", "direct_gap", "indirect_gap", "ifconv"],
+                         sort=[("iteration", 1), ("_id", 1)])
+
+    def wannier_bands(self, material_ids, task_label="GW_BANDSTRUCTURE", arrays=None):
+        """
+        Wannier interpolated bands ("wannier_kpoints", "wannier_eigenvalues")
+        with the special k-points; task_label is "GW_BANDSTRUCTURE" or
+        "CHECK_WANNIER_INTERPOLATION" (which also has the VASP bands).
+        """
+        return self._latest("WANNIER_Results", material_ids, {"stage": task_label},
+                            ["special_kpoint_labels", "special_kpoint_coordinates"], arrays)
+
+    @staticmethod
+    def _gw_query(job_tag):
+        query = {"stage": "scGW", "ifconv": True}
+        if job_tag:
+            query["job_tag"] = job_tag
+        return query
+
+    def _latest(self, collection, material_ids, query, fields, arrays=None):
+        # the last iteration (then the last written document) of each material
+        single = isinstance(material_ids, str)
+        docs = self.find(collection, [material_ids] if single else material_ids, query, fields, arrays,
+                         sort=[("iteration", 1), ("_id", 1)])
+        latest = {doc["material_id"]: doc for doc in docs}
+        return latest.get(material_ids) if single else latest
+
+
+def _to_numpy(value):
+    if isinstance(value, dict):
+        return {k: _to_numpy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        try:
+            return np.asarray(value)
+        except ValueError:
+            return value
+    return value
@@ -4,32 +4,61 @@
 This module defines tasks that support running vasp in various ways.
 """
 
+import hashlib
+import json
 import os
+import shutil
 import subprocess
 
 from atomate.utils.utils import env_chk, get_logger
 from fireworks import explicit_serialize, FiretaskBase
 
+from pyGWBSE.staging import sync_files, file_signature
+
 __author__ = 'Anubhav Jain <ajain@lbl.gov>'
 __credits__ = 'Shyue Ping Ong <ong.sp>'
 
 logger = get_logger(__name__)
 
+# large files written by VASP that are not copied back from the scratch directory,
+# unless they are in keep_files
+SCRATCH_FILES = ["WAVECAR", "WAVEDER", "W*.tmp", "WFULL*.tmp", "CHG", "CHGCAR", "PROCAR", "vaspwave.h5"]
+
+# signatures of the files of the launch directory when they were last staged to the scratch directory
+SYNCED_FILE = ".synced"
+
 
 @explicit_serialize
 class Run_Vasp(FiretaskBase):
     """
     Execute a command directly (no custodian).
 
+    With scratch_dir, VASP runs in a node-local scratch directory instead of the
+    launch directory: the files of the launch directory are copied there, VASP
+    runs, and the outputs are copied back except the large scratch files
+    (SCRATCH_FILES) that are not in keep_files. The scratch directory is kept
+    for the next Run_Vasp of the same Firework (e.g. the next GW iteration reads
+    its WAVECAR and W*.tmp): a file of the launch directory is only copied
+    again if it changed since it was staged (e.g. staged again by
+    CopyOutputFiles), otherwise the version of the scratch directory is kept.
+    The scratch directory is removed at the end of the Firework (CleanScratch),
+    or by the first Run_Vasp of another launch if the Firework did not finish.
+
     Args:
         cmd (str): the name of the full executable to run. Supports env_chk.
 
     Other Parameters:
         expand_vars (str): Set to true to expand variable names in the cmd.
+        scratch_dir (str): root of the scratch directories, e.g. "$TMPDIR" or a
+            local SSD. Supports env_chk, e.g. ">>scratch_dir<<"; VASP runs in
+            the launch directory if it is not set.
+        keep_files ([str]): glob patterns of the scratch files that are copied
+            back, i.e. the files that the child Fireworks or the next tasks read,
+            see wflows.use_scratch.
     """
 
     required_params = ["vasp_cmd"]
-    optional_params = ["expand_vars"]
+    optional_params = ["expand_vars", "scratch_dir", "keep_files"]
 
     def run_task(self, fw_spec):
         """
@@ -38,12 +67,120 @@ class Run_Vasp(FiretaskBase):
         cmd = env_chk(self["vasp_cmd"], fw_spec)
         if self.get("expand_vars", False):
             cmd = os.path.expandvars(cmd)
+        scratch_root = env_chk(self.get("scratch_dir"), fw_spec, strict=False)
+        scratch_root = os.path.expandvars(scratch_root) if scratch_root else None
+        if not scratch_root or "$" in scratch_root:
+            scratch_root = None
+        launch_dir = os.getcwd()
+        scratch = get_scratch_dir(scratch_root, launch_dir) if scratch_root else None
+        if scratch:
+            synced = _load_synced(scratch)
+            staged = sync_files(launch_dir, scratch, exclude=[".owner", SYNCED_FILE], synced=synced)
+            _save_synced(scratch, synced)
+            logger.info("Staged {} to {}".format(staged, scratch))
 
         logger.info("Running command: {}".format(cmd))
-        return_code = subprocess.call(cmd, shell=True)
+        try:
+            return_code = subprocess.call(cmd, shell=True, cwd=scratch)
+        finally:
+            if scratch:
+                copied = sync_files(scratch, launch_dir, exclude=SCRATCH_FILES + [".owner", SYNCED_FILE],
+                                    keep=self.get("keep_files", []))
+                # the copied back files are up to date in the scratch directory
+                for name in copied:
+                    synced[name] = file_signature(os.stat(os.path.join(launch_dir, name)))
+                _save_synced(scratch, synced)
+                logger.info("Copied back {} from {}".format(copied, scratch))
         logger.info("Command {} finished running with returncode: {}".format(cmd, return_code))
 
 
+@explicit_serialize
+class CleanScratch(FiretaskBase):
+    """
+    Remove the scratch directory of the launch directory (see Run_Vasp) at the
+    end of a Firework.
+
+    Other Parameters:
+        scratch_dir (str): root of the scratch directories, as in Run_Vasp.
+    """
+    optional_params = ["scratch_dir"]
+
+    def run_task(self, fw_spec):
+        """
+        Your Comments Here
+        """
+        scratch_root = env_chk(self.get("scratch_dir"), fw_spec, strict=False)
+        scratch_root = os.path.expandvars(scratch_root) if scratch_root else None
+        if scratch_root and "$" not in scratch_root:
+            remove_scratch_dir(scratch_root, os.getcwd())
+
+
+def scratch_name(launch_dir):
+    """
+    Name of the scratch directory of launch_dir.
+    """
+    return "pygwbse-" + hashlib.sha1(os.path.realpath(launch_dir).encode()).hexdigest()[:16]
+
+
+def remove_scratch_dir(scratch_root, launch_dir):
+    """
+    Remove the scratch directory of launch_dir in scratch_root, if any.
+    """
+    scratch = os.path.join(scratch_root, scratch_name(launch_dir))
+    if os.path.isdir(scratch):
+        logger.info("Removing the scratch directory {}".format(scratch))
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def get_scratch_dir(scratch_root, launch_dir):
+    """
+    Scratch directory of launch_dir in scratch_root. The scratch directories of
+    the other launches of this process, and of processes that are not running
+    anymore, are removed.
+    """
+    name = scratch_name(launch_dir)
+    os.makedirs(scratch_root, exist_ok=True)
+    for entry in os.scandir(scratch_root):
+        if not entry.name.startswith("pygwbse-") or entry.name == name or not entry.is_dir():
+            continue
+        try:
+            with open(os.path.join(entry.path, ".owner")) as f:
+                pid = json.load(f)["pid"]
+        except (OSError, ValueError, KeyError):
+            continue
+        if pid == os.getpid() or not _is_running(pid):
+            logger.info("Removing the scratch directory {}".format(entry.path))
+            shutil.rmtree(entry.path, ignore_errors=True)
+    scratch = os.path.join(scratch_root, name)
+    os.makedirs(scratch, exist_ok=True)
+    with open(os.path.join(scratch, ".owner"), "w") as f:
+        json.dump({"pid": os.getpid(), "launch_dir": os.path.realpath(launch_dir)}, f)
+    return scratch
+
+
+def _load_synced(scratch):
+    try:
+        with open(os.path.join(scratch, SYNCED_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_synced(scratch, synced):
+    with open(os.path.join(scratch, SYNCED_FILE), "w") as f:
+        json.dump(synced, f)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 @explicit_serialize
 class Run_Sumo(FiretaskBase):
     """
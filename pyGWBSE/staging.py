@@ -0,0 +1,477 @@
+# coding: utf-8
+
+"""
+This module defines the helpers used to stage the output files of a previous run
+into a new run directory: linking instead of copying, streamed decompression, a
+node-local staging cache that keeps one copy of each large file per node, the
+transfer of many files from a remote host as a single tar stream and the prefetch
+of the inputs of the next run while the current one is finishing.
+"""
+
+import contextlib
+import errno
+import fnmatch
+import hashlib
+import json
+import os
+import queue
+import shlex
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from pyGWBSE.compress import compression_ext, decompress_stream, zopen
+
+__author__ = 'Tathagata Biswas'
+__email__ = 'tbiswas3@asu.edu'
+
+# files that VASP (or Wannier90) only reads when they are inputs of a run, they can
+# be linked to the previous run directory instead of being copied
+LINKABLE_FILES = ["WAVEDER", "W*.tmp", "WFULL*.tmp", "wannier90.mmn", "wannier90.amn", "wannier90.eig"]
+
+# number of consumers of a staging area of prefetch_files that did not release it
+CONSUMERS_FILE = ".consumers"
+
+# ioctl request to clone a file on btrfs, xfs, ... (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dest, linkable=False, allow_symlink=True):
+    """
+    Stage src as dest without copying its data if possible. A reflink (copy-on-write
+    clone) is tried first; a file that is only read may also be hardlinked, or
+    symlinked if src is on another filesystem and allow_symlink. The file is copied
+    if none of these is possible. Returns the method that was used.
+    """
+    src = os.path.realpath(src)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    methods = [("reflink", reflink_file)]
+    if linkable:
+        methods += [("hardlink", os.link)]
+        if allow_symlink:
+            methods += [("symlink", os.symlink)]
+    for method, func in methods:
+        try:
+            func(src, dest)
+            return method
+        except OSError:
+            if os.path.lexists(dest):
+                os.remove(dest)
+    shutil.copy2(src, dest)
+    return "copy"
+
+
+def reflink_file(src, dest):
+    """
+    Copy-on-write clone of src to dest, raises OSError if the filesystem (or the
+    platform) does not support it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+    shutil.copystat(src, dest)
+
+
+def decompress_file(src, dest, remove_src=True, chunk_size=1 << 20):
+    """
+    Decompress src (.gz, .zst, ... as given by its extension) to dest and remove
+    src if remove_src. The file is streamed in binary mode with chunk_size bytes at a time, so memory use does
+    not depend on the size of the file and binary files (WAVECAR, WAVEDER, ...)
+    are not altered.
+    """
+    tmp = dest + ".part"
+    with zopen(src, 'rb') as f_in, open(tmp, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, chunk_size)
+    os.replace(tmp, dest)
+    if remove_src:
+        os.remove(src)
+    return dest
+
+
+class StagingCache:
+    """
+    Node-local cache of staged files, e.g. in /tmp or on a local SSD.
+
+    A file is read from the (shared) source filesystem the first time it is
+    staged on a node, then every run directory gets it from the cache: by hardlink
+    if the file is only read by VASP and the run directory is on the same
+    filesystem as the cache, by reflink or by a local copy otherwise.
+
+    Files are keyed by (source path, size, modification time). With checksum=True
+    the cached data is in addition stored under the sha256 of its content, so
+    identical files from different source paths are stored once. The cache is
+    bounded to max_size bytes, the least recently used files are removed first.
+    Cached files are read-only, so a linked file can not be modified by a run.
+
+    Args:
+        root (str): cache directory.
+        max_size (int): maximum size of the cache in bytes.
+        checksum (bool): deduplicate the cached files by content.
+        min_size (int): smaller files are not cached.
+    """
+
+    def __init__(self, root, max_size=100 * 1024 ** 3, checksum=False, min_size=1 << 20):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.checksum = checksum
+        self.min_size = min_size
+        for d in ("objects", "keys", "locks"):
+            os.makedirs(os.path.join(self.root, d), exist_ok=True)
+
+    def path_key(self, src, decompress=False):
+        """
+        Key of the source file: hash of its real path, size and modification time.
+        """
+        src = os.path.realpath(src)
+        st = os.stat(src)
+        return hashlib.sha1("{}\0{}\0{}\0{}".format(src, st.st_size, st.st_mtime_ns, decompress).encode()).hexdigest()
+
+    def fetch(self, src, dest, linkable=False, decompress=False):
+        """
+        Stage src as dest through the cache, src is decompressed if decompress.
+        Returns 'hit:<method>' or 'miss:<method>', where method is the way dest was
+        made from the cached file.
+        """
+        key = self.path_key(src, decompress)
+        with self._lock(key):
+            obj = self._lookup(key)
+            hit = obj is not None
+            if not hit:
+                obj = self._ingest(src, key, decompress)
+            # the modification time of a cached file is its last use
+            os.utime(obj)
+        method = link_or_copy(obj, dest, linkable, allow_symlink=False)
+        if method != "hardlink":
+            # a private copy must be writable, VASP may rewrite it
+            os.chmod(dest, os.stat(dest).st_mode | stat.S_IWUSR)
+        if not hit:
+            self.evict(keep=obj)
+        return "{}:{}".format("hit" if hit else "miss", method)
+
+    def _lookup(self, key):
+        """
+        Path of the cached file of key, None if it is not in the cache.
+        """
+        if self.checksum:
+            try:
+                with open(os.path.join(self.root, "keys", key)) as f:
+                    key = f.read().strip()
+            except OSError:
+                return None
+        obj = os.path.join(self.root, "objects", key)
+        return obj if os.path.exists(obj) else None
+
+    def _ingest(self, src, key, decompress):
+        """
+        Copy src into the cache, returns the path of the cached file.
+        """
+        tmp = os.path.join(self.root, "objects", "{}.{}.part".format(key, uuid.uuid4().hex))
+        sha = hashlib.sha256()
+        with (zopen(src, 'rb') if decompress else open(src, 'rb')) as f_in, open(tmp, 'wb') as f_out:
+            for chunk in iter(lambda: f_in.read(1 << 20), b""):
+                f_out.write(chunk)
+                if self.checksum:
+                    sha.update(chunk)
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        name = sha.hexdigest() if self.checksum else key
+        obj = os.path.join(self.root, "objects", name)
+        if self.checksum and os.path.exists(obj):
+            # same content from another source path
+            os.remove(tmp)
+        else:
+            os.replace(tmp, obj)
+        if self.checksum:
+            with open(os.path.join(self.root, "keys", key), "w") as f:
+                f.write(name)
+        return obj
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits in max_size.
+        """
+        with self._lock("evict"):
+            objects = []
+            for entry in os.scandir(os.path.join(self.root, "objects")):
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    st = entry.stat()
+                    objects.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for mtime, size, path in objects)
+            for mtime, size, path in sorted(objects):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                    total -= size
+
+    @contextlib.contextmanager
+    def _lock(self, name):
+        """
+        Exclusive lock between the processes that use the cache.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(os.path.join(self.root, "locks", name + ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_tar_stream(from_dir, names, ssh=None):
+    """
+    Start packing the files names of from_dir into a tar archive that is written to
+    a stream, by running tar on the remote host of the paramiko SSHClient ssh or,
+    if ssh is None, locally (loopback). Symbolic links are followed.
+
+    Returns:
+        (stream, wait) where wait() returns the exit status of tar.
+    """
+    cmd = "tar -C {} -chf - -- {}".format(shlex.quote(from_dir), " ".join(shlex.quote(n) for n in names))
+    if ssh is None:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        return proc.stdout, proc.wait
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    stdin.close()
+    return stdout, stdout.channel.recv_exit_status
+
+
+def unpack_tar_stream(stream, targets, chunk_size=1 << 20):
+    """
+    Unpack a tar archive from a (non seekable) stream while it is received. The
+    files keep the permissions and modification time of their members.
+
+    Args:
+        stream: file-like object with the archive.
+        targets (dict): {name in the archive: (destination path, decompress)},
+            other members are skipped; compressed members (.gz, .zst, ...) with
+            decompress=True are decompressed on the fly.
+        chunk_size (int): number of bytes written at a time.
+
+    Returns:
+        [dict] of the destination file, number of bytes and time of each file.
+    """
+    stats = []
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        start = time.time()
+        for member in tar:
+            if member.name not in targets or not member.isfile():
+                continue
+            dest, decompress = targets[member.name]
+            f_in = tar.extractfile(member)
+            if decompress:
+                f_in = decompress_stream(f_in, compression_ext(member.name))
+            tmp = dest + ".part"
+            with open(tmp, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, chunk_size)
+            os.chmod(tmp, member.mode & 0o7777)
+            os.replace(tmp, dest)
+            os.utime(dest, (member.mtime, member.mtime))
+            # the time of a file includes the transfer of the archive up to it
+            now = time.time()
+            stats.append({"dest": dest, "bytes": os.path.getsize(dest), "time": now - start,
+                          "method": "bulk+decompress" if decompress else "bulk"})
+            start = now
+    return stats
+
+
+def prefetch_files(src_dir, names, stage_dir, workers=4, consumers=1):
+    """
+    Start staging the files names of src_dir into stage_dir in background threads
+    and return without waiting; compressed files are decompressed. Each staged
+    file gets a <name>.key file, written once the file is complete, with the
+    path, size and modification time of its source (see claim_prefetched). The
+    threads are daemon threads, so the process does not wait for them before it
+    exits: a file that is interrupted has no key and is copied as usual by the
+    children.
+
+    stage_dir is emptied first, which removes what an earlier prefetch left
+    (e.g. the .part files of threads killed with their process), and it is
+    removed when its consumers have all released it (see release_prefetched).
+
+    Returns:
+        [Future] of the staged files.
+    """
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.makedirs(stage_dir, exist_ok=True)
+    with open(os.path.join(stage_dir, CONSUMERS_FILE), "w") as f:
+        f.write(str(consumers))
+    jobs = queue.Queue()
+    futures = []
+    for name in names:
+        future = Future()
+        jobs.put((os.path.join(src_dir, name), future))
+        futures.append(future)
+    for i in range(max(min(workers, len(names)), 1)):
+        threading.Thread(target=_prefetch_worker, args=(jobs, stage_dir), name="prefetch-{}".format(i),
+                         daemon=True).start()
+    return futures
+
+
+def _prefetch_worker(jobs, stage_dir):
+    while True:
+        try:
+            src, future = jobs.get_nowait()
+        except queue.Empty:
+            return
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(_prefetch_file(src, stage_dir))
+        except Exception as exc:
+            future.set_exception(exc)
+
+
+def _prefetch_file(src, stage_dir):
+    staged = os.path.join(stage_dir, os.path.basename(src))
+    key = json.dumps(_source_key(src))
+    # a stale key must not validate the new file
+    if os.path.exists(staged + ".key"):
+        os.remove(staged + ".key")
+    try:
+        if compression_ext(src):
+            decompress_file(src, staged, remove_src=False)
+        else:
+            tmp = staged + ".part"
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, staged)
+        with open(staged + ".key.part", "w") as f:
+            f.write(key)
+        os.replace(staged + ".key.part", staged + ".key")
+    except Exception:
+        # no partial file or key is left to be claimed
+        for path in (staged + ".part", staged, staged + ".key.part", staged + ".key"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return staged
+
+
+def _source_key(src):
+    st = os.stat(src)
+    return [os.path.realpath(src), st.st_size, st.st_mtime_ns]
+
+
+def claim_prefetched(stage_dir, src, dest, linkable=False):
+    """
+    Stage dest from the copy of src prefetched in stage_dir, if there is a
+    complete one made from the current version of src. A file that is only read
+    is hardlinked (it may be claimed by several runs, the staged copy is removed
+    by release_prefetched), another file is moved to dest. Returns the method that was used, None if src was not prefetched.
+    """
+    staged = os.path.join(stage_dir, os.path.basename(src))
+    try:
+        with open(staged + ".key") as f:
+            if json.load(f) != _source_key(src):
+                return None
+        if linkable:
+            return "prefetch:" + link_or_copy(staged, dest, linkable=True, allow_symlink=False)
+        os.remove(staged + ".key")
+        try:
+            os.replace(staged, dest)
+            return "prefetch:move"
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            method = link_or_copy(staged, dest)
+            os.remove(staged)
+            return "prefetch:" + method
+    except (OSError, ValueError):
+        # not prefetched, not complete or claimed by another run
+        return None
+
+
+def release_prefetched(stage_dir):
+    """
+    Record that a consumer is done with the staging area stage_dir: the last
+    of the consumers given to prefetch_files removes it, with the files that
+    were not claimed or were only linked. Returns True if stage_dir was removed.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    try:
+        with open(os.path.join(stage_dir, CONSUMERS_FILE), "r+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            left = int(f.read() or 1) - 1
+            if left > 0:
+                f.seek(0)
+                f.truncate()
+                f.write(str(left))
+                return False
+    except (OSError, ValueError):
+        # released by the last consumer already
+        return False
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    return True
+
+
+def file_signature(st):
+    """
+    Signature of a file from its stat: inode, size, modification and change
+    times. A file copied with copy2 or linked again keeps its modification time
+    but gets a new signature.
+    """
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def sync_files(src_dir, dest_dir, exclude=(), keep=(), synced=None):
+    """
+    Copy the files of src_dir to dest_dir, keeping their modification times. A
+    file is copied when it is missing in dest_dir or its size or modification
+    time differ. Files matching the glob patterns exclude are skipped unless
+    they also match keep; directories are not copied.
+
+    With synced, {name: signature of the file of src_dir when it was last
+    copied} (updated in place), a file that did not change in src_dir since it
+    was last copied is not copied again, even if dest_dir has another version
+    (e.g. rewritten by the previous run), and a file that changed in src_dir
+    (e.g. staged again by CopyOutputFiles, with its old modification time) is
+    always copied.
+
+    Returns:
+        [str] names of the copied files.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    copied = []
+    for entry in os.scandir(src_dir):
+        if not entry.is_file() or entry.name.endswith(".part"):
+            continue
+        if any(fnmatch.fnmatch(entry.name, p) for p in exclude) and \
+                not any(fnmatch.fnmatch(entry.name, p) for p in keep):
+            continue
+        dest = os.path.join(dest_dir, entry.name)
+        st = entry.stat()
+        try:
+            dest_st = os.stat(dest)
+        except OSError:
+            dest_st = None
+        if dest_st is not None:
+            if synced is not None and entry.name in synced:
+                if synced[entry.name] == file_signature(st):
+                    continue
+            elif dest_st.st_size == st.st_size and dest_st.st_mtime_ns == st.st_mtime_ns:
+                continue
+        tmp = dest + ".part"
+        shutil.copy2(entry.path, tmp)
+        os.replace(tmp, dest)
+        if synced is not None:
+            synced[entry.name] = file_signature(st)
+        copied.append(entry.name)
+    return sorted(copied)
@@ -1,17 +1,24 @@
 # coding: utf-8
 
+import fnmatch
 import glob
-import gzip
+import hashlib
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from atomate.common.firetasks.glue_tasks import CopyFiles, get_calc_loc
 from atomate.utils.utils import env_chk, get_logger
 from fireworks import explicit_serialize, FiretaskBase, FWAction
-from pymatgen.io.vasp import Vasprun, Locpot
 from pymatgen.io.vasp.inputs import Incar
-from pymatgen.core import Structure
 
+from pyGWBSE.compress import COMPRESSED_EXTS, compress_outputs
 from pyGWBSE.inputset import CreateInputs
+from pyGWBSE.run_calc import CleanScratch
+from pyGWBSE.staging import LINKABLE_FILES, StagingCache, claim_prefetched, decompress_file, link_or_copy, \
+                            open_tar_stream, prefetch_files, release_prefetched, unpack_tar_stream
+from pyGWBSE.readers import LazyVasprun, EigenvalueSet, read_band_properties, read_sumo_bandstats, \
+                            read_locpot_planar_average, find_vacuum_plane
 
 """
 This module defines tasks that acts as a glue between other vasp Firetasks to allow communication
@@ -39,9 +46,7 @@ class CheckBeConv(FiretaskBase):
         niter = self["niter"]
         conv = self["no_conv"]
         tol = self["tolerence"]
-        filename = str(os.getcwd()) + '/vasprun.xml'
-        vasprun = Vasprun(filename)
-        gap, cbm, vbm, is_direct = vasprun.eigenvalue_band_properties
+        eigenvalues, (gap, cbm, vbm, is_direct) = read_band_properties(os.getcwd())
         print()
         print('=================================================')
         print('Iteration:', niter)
@@ -76,11 +81,9 @@ class SaveNbandsov(FiretaskBase):
     def run_task(self, fw_spec):
 
         enwinbse = self["enwinbse"]
-        filename = str(os.getcwd()) + '/vasprun.xml'
-        vasprun = Vasprun(filename)
-        qpe=vasprun.eigenvalues
-        gap, cbm, vbm, is_direct = vasprun.eigenvalue_band_properties
-        nbandso,nbandsv=get_nbandsov(qpe,vbm,cbm,enwinbse)   
+        # the band window needs all the bands, not only the NBANDSGW bands of the QP table
+        qpe, (gap, cbm, vbm, is_direct) = read_band_properties(os.getcwd(), sources=("EIGENVAL", "vasprun.xml"))
+        nbandso,nbandsv=qpe.band_window(vbm,cbm,enwinbse)
 
         return FWAction(update_spec={"nbandso": nbandso, "nbandsv": nbandsv})
 
@@ -99,16 +102,105 @@ class SaveConvParams(FiretaskBase):
 class StopIfConverged(FiretaskBase):
     """
     Your Comments Here
+
+    Other Parameters:
+        compress_outputs (dict): parameters of CompressOutputs, the outputs are
+            compressed before the Firework is stopped.
+        scratch_dir (str): root of the scratch directories of Run_Vasp, the
+            scratch directory is removed before the Firework is stopped.
     """
+    optional_params = ["compress_outputs", "scratch_dir"]
+
     def run_task(self, fw_spec):
         """
         Your Comments Here
         """
         ifconv = fw_spec["ifconv"]
         if ifconv:
+            if self.get("compress_outputs") is not None:
+                CompressOutputs(**self["compress_outputs"]).run_task(fw_spec)
+            if self.get("scratch_dir"):
+                CleanScratch(scratch_dir=self["scratch_dir"]).run_task(fw_spec)
             return FWAction(exit=True)
 
 
+@explicit_serialize
+class CompressOutputs(FiretaskBase):
+    """
+    Compress the large text outputs of the finished run in the current
+    directory, several files at a time. The readers of pyGWBSE and
+    CopyOutputFiles read the compressed files transparently.
+
+    Other Parameters:
+        files ([str]): glob patterns of the files to compress, default:
+            pyGWBSE.compress.OUTPUT_FILES and their .relax* versions.
+        method (str): "gzip" (default) or "zstd" (needs the zstandard package).
+        level (int): compression level.
+        workers (int): number of files compressed at the same time (default: 4).
+        min_size (int): smaller files are not compressed (default: 1 MB).
+    """
+    optional_params = ["files", "method", "level", "workers", "min_size"]
+
+    def run_task(self, fw_spec):
+        """
+        Your Comments Here
+        """
+        start = time.time()
+        files = compress_outputs(os.getcwd(), patterns=self.get("files"), method=self.get("method", "gzip"),
+                                 level=self.get("level"), workers=self.get("workers", 4),
+                                 min_size=self.get("min_size", 1 << 20))
+        nbytes = sum(stat["bytes"] for stat in files)
+        ncompressed = sum(stat["compressed_bytes"] for stat in files)
+        logger.info("compressed {} files, {} bytes to {} bytes in {:.2f} s".format(
+            len(files), nbytes, ncompressed, time.time() - start))
+        return FWAction(stored_data={"compress_stats": {"bytes": nbytes, "compressed_bytes": ncompressed,
+                                                        "time": time.time() - start, "files": files}})
+
+
+@explicit_serialize
+class PrefetchFiles(FiretaskBase):
+    """
+    Start staging the files that the child Fireworks will copy (CopyOutputFiles)
+    into a staging area, in background threads, as soon as VASP is finished, so
+    that the copy overlaps with the rest of the Firework (e.g. the DB
+    ingestion). The staging area is passed to the children in their spec; their
+    CopyOutputFiles then only verifies and links (or moves) the staged files, and
+    copies the files that are not staged (yet) as usual. The staging area is
+    removed once every child has copied its files.
+
+    Other Parameters:
+        files ([str]): glob patterns of the files to prefetch,
+            e.g. ["WAVECAR", "WAVEDER", "W*.tmp"].
+        prefetch_dir (str): staging area, on the filesystem of the run
+            directories of the children. Supports env_chk, default:
+            >>prefetch_dir<< of the FWorker env; nothing is prefetched if it is
+            not set.
+        when_converged (bool): only prefetch if the run is converged (ifconv in
+            the spec), for the iterations of a self-consistent loop.
+        workers (int): number of files staged at the same time (default: 2).
+        consumers (int): number of children that copy the files (default: 1);
+            nothing is prefetched if it is 0.
+    """
+    required_params = ["files"]
+    optional_params = ["prefetch_dir", "when_converged", "workers", "consumers"]
+
+    def run_task(self, fw_spec):
+        """
+        Your Comments Here
+        """
+        prefetch_dir = env_chk(self.get("prefetch_dir", ">>prefetch_dir<<"), fw_spec, strict=False)
+        if not prefetch_dir or not self.get("consumers", 1) or \
+                (self.get("when_converged") and not fw_spec.get("ifconv")):
+            return None
+        calc_dir = os.getcwd()
+        names = sorted(f for f in os.listdir(calc_dir) if any(fnmatch.fnmatch(f, p) for p in self["files"]))
+        stage_dir = os.path.join(prefetch_dir, hashlib.sha1(os.path.realpath(calc_dir).encode()).hexdigest()[:16])
+        prefetch_files(calc_dir, names, stage_dir, workers=self.get("workers", 2),
+                       consumers=self.get("consumers", 1))
+        logger.info("prefetching {} to {}".format(names, stage_dir))
+        return FWAction(update_spec={"prefetched": {"calc_dir": calc_dir, "stage_dir": stage_dir}})
+
+
 @explicit_serialize
 class PasscalClocsCond(FiretaskBase):
     """
@@ -180,50 +272,18 @@ class WriteGWInput(FiretaskBase):
         vis.write_input(".")
 
 
-def read_emcpyout(fname):                                                       
-    f = open(fname)                                                             
-    contents = f.readlines()                                                    
-    f.close()                                                                   
-    ne=0                                                                        
-    nh=0                                                                        
-    h_res={}                                                                    
-    e_res={}                                                                    
-    for content in contents:                                                    
-        if "m_h:" in content:                                                   
-            nh=nh+1                                                             
-            lines = str.split(content)                                          
-            hmass=eval(lines[1])                                                
-            hibnd=eval(lines[4])                                                
-            inda=lines.index('->')                                              
-            if inda==10:                                                        
-                hdir1=lines[9]                                                  
-                hdir2=lines[14]                                                 
-            else:                                                               
-                hdir1='Intermediate'                                            
-                hdir2=lines[13]                                                 
-                                                                                
-            h_res['mass'+str(nh)+': '+str(hibnd)+', '+hdir1+', '+hdir2]=hmass   
-                                                                                
-        if "m_e:" in content:                                                   
-            ne=ne+1                                                             
-            lines = str.split(content)                                          
-            emass=eval(lines[1])                                                
-            eibnd=eval(lines[4])                                                
-            inda=lines.index('->')                                              
-            if inda==10:                                                        
-                edir1=lines[9]                                                  
-                edir2=lines[14]                                                 
-            else:                                                               
-                edir1='Intermediate'                                            
-                edir2=lines[13]                                                 
-                                                                                
-                                                                                
-            e_res['mass'+str(ne)+': '+str(eibnd)+', '+edir1+', '+edir2]=emass   
-                                                                                
-    return h_res, e_res   
+def read_emcpyout(fname):
+    """
+    Read the hole and electron effective masses from sumo-bandstats.log.
+    """
+    return read_sumo_bandstats(fname)
 
 def read_epsilon(fname):
-    vasprun = Vasprun(fname)
+    """
+    Read the static dielectric tensor (IPA) from a vasprun.xml file name or from
+    an already parsed LazyVasprun (or Vasprun) object.
+    """
+    vasprun = LazyVasprun(fname, profile="read_epsilon") if isinstance(fname, str) else fname
     try:
         epsilon = vasprun.ionic_steps[-1]["dielectric_ipa"] #vasprun.epsilon_static_wolfe
     except:
@@ -243,30 +303,15 @@ def calc_delta_evac(x,y,n0):
 
 
 def read_vac_level(locpot_fname,fname):
-    lpot=Locpot.from_file(locpot_fname)
-    vrun=Vasprun(fname)
-    vrun_d=vrun.as_dict()
-    struct=Structure.from_dict(vrun_d["input"]["crystal"])
-    latt_c=struct.lattice.c
-    y=lpot.get_average_along_axis(2)
-    zarr=lpot.get_axis_grid(2)
-
-    dist_z0=0.
-    z0=0.
-
-    for n,z in enumerate(zarr):
-        dist=[]
-        for site in struct.sites:
-            pos_z=site.coords[2]
-            if pos_z<0:
-                pos_z=pos_z+latt_c
-            dist.append(abs(pos_z-z))
-            dist.append(abs(pos_z+latt_c-z))
-        dist_z=min(dist)
-        if dist_z>dist_z0:
-            dist_z0=dist_z
-            z0=z
-            n0=n
+    """
+    Find the vacuum level from the planar average of LOCPOT. fname can be the
+    name of the vasprun.xml file or an already parsed LazyVasprun (or Vasprun) object.
+    """
+    zarr, y = read_locpot_planar_average(locpot_fname)
+    vrun = LazyVasprun(fname, profile="read_vac_level") if isinstance(fname, str) else fname
+    struct=vrun.initial_structure
+    site_z = [site.coords[2] for site in struct.sites]
+    n0 = find_vacuum_plane(zarr, site_z, struct.lattice.c)
 
     evac=y[n0]
     zvac=zarr[n0]
@@ -275,51 +320,16 @@ def read_vac_level(locpot_fname,fname):
     return zvac,evac,delta_evac
 
 def get_gap_from_dict(qp_energies):
+    """
+    Indirect and direct gap from a {Spin: array(nkpt, nband, 2)} dict or an EigenvalueSet.
+    """
+    return EigenvalueSet.from_dict(qp_energies).gaps(occu_tol=1e-5)
 
-    tol=1e-5
-    vbm = -float("inf")
-    cbm = float("inf")
-    for spin, d in qp_energies.items():
-        for k, val in enumerate(d):
-            for (eigenval, occu) in val:
-                if occu > tol and eigenval > vbm:
-                    vbm = eigenval
-                elif occu <= tol and eigenval < cbm:
-                    cbm = eigenval
-    igap=max(cbm-vbm,0)
-
-    gap = []
-    filled = 1.0
-    tol=1e-5
-    vbm=0
-    cbm=0
-    for spin, d in qp_energies.items():
-        for k, val in enumerate(d):
-            for (eigenval, occu) in val:
-                if abs(occu-filled)<=tol:
-                    vbm=eigenval
-                else:
-                    cbm=eigenval
-                    gap.append(cbm-vbm)
-                    break
-    dgap=min(gap)
-    return igap,dgap
-
-def get_nbandsov(qp_energies,vbm,cbm,enwinbse):                                      
-                                                                                
-    tol=1e-5                                                                    
-    nvb=[]                                                                      
-    ncb=[]                                                                      
-    for spin, d in qp_energies.items():                                         
-        for k, val in enumerate(d):                                             
-            for ibnd,(eigenval, occ) in enumerate(val):                         
-                if abs(occ-1.0)<tol and (vbm-eigenval)<=enwinbse:                  
-                    nvb.append(ibnd+1)                                          
-                if occ<tol and (eigenval-cbm)<=enwinbse:                           
-                    ncb.append(ibnd+1)                                          
-                                                                                
-    return max(nvb)-min(nvb)+1,max(ncb)-min(ncb)+1                              
-                                                                                
+def get_nbandsov(qp_energies,vbm,cbm,enwinbse):
+    """
+    NBANDSO and NBANDSV for the BSE energy window enwinbse around the band edges.
+    """
+    return EigenvalueSet.from_dict(qp_energies).band_window(vbm, cbm, enwinbse, occu_tol=1e-5)
 
 
 @explicit_serialize
@@ -328,8 +338,10 @@ class CopyOutputFiles(CopyFiles):
     Copy files from a previous VASP run directory to the current directory.
     By default, copies 'INCAR', 'POSCAR' (default: via 'CONTCAR'), 'KPOINTS', 
     'POTCAR', 'OUTCAR', and 'vasprun.xml'. Additional files, e.g. 'CHGCAR', 
-    can also be specified. Automatically handles files that have a ".gz" 
-    extension (copies and unzips).
+    can also be specified. Automatically handles files that have a ".gz",
+    ".zst" or another compression extension (copies and decompresses).
+    Files that the previous run has already staged (PrefetchFiles) are only
+    verified and linked or moved.
 
     Note that you must specify either "calc_loc" or "calc_dir" to indicate
     the directory containing the previous VASP run.
@@ -347,10 +359,34 @@ class CopyOutputFiles(CopyFiles):
             everything
         contcar_to_poscar(bool): If True (default), will move CONTCAR to
             POSCAR (original POSCAR is not copied).
+        copy_workers (int): number of files that are copied (and unzipped) at
+            the same time (default: 4). Files from a remote filesystem are always
+            copied one at a time.
+        staging (str): "copy" (default) copies every file. "link" stages the
+            files without copying their data when both directories are on the
+            same (local) filesystem: files that VASP only reads (link_files) are
+            reflinked, hardlinked or symlinked, the other files are reflinked
+            (copy-on-write) where the filesystem supports it and copied otherwise.
+            "cache" stages the large files through the node-local StagingCache
+            in staging_cache, and behaves as "link" if there is none.
+        link_files ([str]): glob patterns of the files that may be linked,
+            default: LINKABLE_FILES.
+        staging_cache (str): directory of the staging cache. Supports env_chk,
+            default: >>staging_cache<< of the FWorker env.
+        staging_cache_size (float): maximum size of the staging cache in GB
+            (default: 100).
+        staging_cache_checksum (bool): deduplicate the cached files by content.
+        bulk_transfer (bool): transfer all the files as one tar stream, packed by
+            tar on the source host and unpacked (and unzipped) while it is
+            received, instead of one SFTP transfer per file. Default: True for a
+            remote filesystem, False otherwise; True with a local calc_dir runs
+            tar locally.
     """
 
     optional_params = ["calc_loc", "calc_dir", "filesystem", "additional_files",
-                       "contcar_to_poscar"]
+                       "contcar_to_poscar", "copy_workers", "staging", "link_files",
+                       "staging_cache", "staging_cache_size", "staging_cache_checksum",
+                       "bulk_transfer"]
 
     def run_task(self, fw_spec):
         """
@@ -360,6 +396,40 @@ class CopyOutputFiles(CopyFiles):
                                 fw_spec["calc_locs"]) if self.get(
             "calc_loc") else {}
 
+        files_to_copy = self.get_files_to_copy(fw_spec)
+        prefetched = fw_spec.get("prefetched")
+
+        # setup the node-local staging cache
+        self.staging_cache = None
+        if self.get("staging") == "cache":
+            cache_dir = env_chk(self.get("staging_cache", ">>staging_cache<<"), fw_spec, strict=False)
+            if cache_dir:
+                self.staging_cache = StagingCache(cache_dir,
+                                                  max_size=int(self.get("staging_cache_size", 100) * 1024 ** 3),
+                                                  checksum=self.get("staging_cache_checksum", False))
+            else:
+                logger.info("no staging_cache directory, files are staged by link")
+
+        # setup the copy
+        self.setup_copy(self.get("calc_dir", None),
+                        filesystem=self.get("filesystem", None),
+                        files_to_copy=files_to_copy, from_path_dict=calc_loc)
+        # use the files prefetched by the previous run
+        self.prefetch_dir = None
+        if prefetched and self.fileclient.ssh is None and \
+                os.path.realpath(prefetched["calc_dir"]) == os.path.realpath(self.from_dir):
+            self.prefetch_dir = prefetched["stage_dir"]
+        # do the copying
+        copy_stats = self.copy_files()
+        if self.prefetch_dir:
+            release_prefetched(self.prefetch_dir)
+        return FWAction(stored_data={"copy_stats": copy_stats})
+
+    def get_files_to_copy(self, fw_spec):
+        """
+        Names of the files copied by the task for the spec fw_spec, None if all the
+        files are copied ($ALL).
+        """
         # determine what files need to be copied
         files_to_copy = None
         if not "$ALL" in self.get("additional_files", []):
@@ -369,7 +439,7 @@ class CopyOutputFiles(CopyFiles):
                 files_to_copy.extend(self["additional_files"])
             if "wfiles" in fw_spec.keys():
                 files2copy = fw_spec["wfiles"]
-                print(files2copy)
+                logger.debug("W files to copy: {}".format(files2copy))
                 files_to_copy.extend(files2copy)
 
         # decide between poscar and contcar
@@ -378,30 +448,30 @@ class CopyOutputFiles(CopyFiles):
             files_to_copy.append("CONTCAR")
             files_to_copy = [f for f in files_to_copy if
                              f != 'POSCAR']  # remove POSCAR
-
-        # setup the copy
-        self.setup_copy(self.get("calc_dir", None),
-                        filesystem=self.get("filesystem", None),
-                        files_to_copy=files_to_copy, from_path_dict=calc_loc)
-        # do the copying
-        self.copy_files()
+        return files_to_copy
 
     def copy_files(self):
         """
-        Your Comments Here
+        Copy the files with a pool of copy_workers threads, or as a single tar
+        stream (bulk_transfer).
+
+        Returns:
+            dict of the number of bytes, time and rate (bytes/s) of the whole copy
+            and, in "files", of each file.
         """
         all_files = self.fileclient.listdir(self.from_dir)
-        # start file copy
+        jobs = []
+        # find the files to copy
         for f in self.files_to_copy:
             prev_path_full = os.path.join(self.from_dir, f)
-            print(prev_path_full)
+            logger.debug("copying {}".format(prev_path_full))
             dest_fname = 'POSCAR' if f == 'CONTCAR' and self.get(
                 "contcar_to_poscar", True) else f
             dest_path = os.path.join(self.to_dir, dest_fname)
 
             relax_ext = ""
-            relax_paths = sorted(
-                self.fileclient.glob(prev_path_full + ".relax*"))
+            # use the listing of from_dir, a glob is a round trip on a remote filesystem
+            relax_paths = sorted(fnmatch.filter(all_files, f + ".relax*"))
             if relax_paths:
                 if len(relax_paths) > 9:
                     raise ValueError(
@@ -409,26 +479,98 @@ class CopyOutputFiles(CopyFiles):
                 m = re.search('\.relax\d*', relax_paths[-1])
                 relax_ext = m.group(0)
 
-            # detect .gz extension if needed - note that monty zpath() did not seem useful here
+            # detect the compression extension (.gz, .zst, ...) if needed - note that monty zpath() did
+            # not seem useful here. A plain file is preferred, it is only removed once it is compressed
             gz_ext = ""
             if not (f + relax_ext) in all_files:
-                for possible_ext in [".gz", ".GZ"]:
-                    if (f + relax_ext + possible_ext) in all_files:
+                for possible_file in all_files:
+                    possible_ext = possible_file[len(f + relax_ext):]
+                    if possible_file.startswith(f + relax_ext) and possible_ext.lower() in COMPRESSED_EXTS:
                         gz_ext = possible_ext
 
             if not (f + relax_ext + gz_ext) in all_files:
                 raise ValueError("Cannot find file: {}".format(f))
 
             # copy the file (minus the relaxation extension)
-            self.fileclient.copy(prev_path_full + relax_ext + gz_ext,
-                                 dest_path + gz_ext)
-
-            # unzip the .gz if needed
-            if gz_ext in ['.gz', ".GZ"]:
-                # unzip dest file
-                f = gzip.open(dest_path + gz_ext, 'rt')
-                file_content = f.read()
-                with open(dest_path, 'w') as f_out:
-                    f_out.writelines(file_content)
-                f.close()
-                os.remove(dest_path + gz_ext)
+            jobs.append((f, prev_path_full + relax_ext + gz_ext, dest_path, gz_ext))
+
+        # start file copy
+        start = time.time()
+        if self.get("bulk_transfer", self.fileclient.ssh is not None):
+            nworkers = 1
+            files = self.bulk_copy(jobs)
+        else:
+            nworkers = self.get("copy_workers", 4) if self.fileclient.ssh is None else 1
+            with ThreadPoolExecutor(max_workers=max(min(nworkers, len(jobs)), 1)) as executor:
+                files = list(executor.map(lambda job: self.copy_file(*job), jobs))
+        elapsed = time.time() - start
+        nbytes = sum(stat["bytes"] for stat in files)
+        logger.info("copied {} files, {} bytes in {:.2f} s ({:.1f} MB/s) with {} workers".format(
+            len(files), nbytes, elapsed, nbytes / max(elapsed, 1e-9) / 1e6, nworkers))
+        return {"bytes": nbytes, "time": elapsed, "rate": nbytes / max(elapsed, 1e-9), "files": files}
+
+    def copy_file(self, fname, src, dest, gz_ext=""):
+        """
+        Copy (and unzip) one file, returns the number of bytes, time and rate of
+        the copy and the method that was used.
+        """
+        start = time.time()
+        cache = getattr(self, "staging_cache", None)
+        prefetch_dir = getattr(self, "prefetch_dir", None)
+        # files staged by the previous run are only verified and linked (or moved)
+        method = claim_prefetched(prefetch_dir, src, dest, self.is_linkable(fname)) if prefetch_dir else None
+        if method is None and cache is not None and self.fileclient.ssh is None and os.path.getsize(src) >= cache.min_size:
+            method = cache.fetch(src, dest, self.is_linkable(fname), decompress=bool(gz_ext))
+        elif method is None and gz_ext and self.fileclient.ssh is None:
+            # local compressed files are decompressed straight from the previous directory
+            decompress_file(src, dest, remove_src=False)
+            method = "decompress"
+        elif method is None:
+            method = self.stage_file(src, dest + gz_ext, fname)
+            # decompress the file if needed
+            if gz_ext:
+                decompress_file(dest + gz_ext, dest)
+                method += "+decompress"
+        elapsed = time.time() - start
+        nbytes = os.path.getsize(dest)
+        logger.info("{}: {} bytes in {:.3f} s ({:.1f} MB/s) by {}".format(
+            dest, nbytes, elapsed, nbytes / max(elapsed, 1e-9) / 1e6, method))
+        return {"file": os.path.basename(dest), "method": method, "bytes": nbytes, "time": elapsed,
+                "rate": nbytes / max(elapsed, 1e-9)}
+
+    def bulk_copy(self, jobs):
+        """
+        Transfer the files of jobs as one tar stream, see bulk_transfer.
+        """
+        targets = {os.path.basename(src): (dest, bool(gz_ext)) for fname, src, dest, gz_ext in jobs}
+        stream, wait = open_tar_stream(self.from_dir, sorted(targets), ssh=self.fileclient.ssh)
+        stats = unpack_tar_stream(stream, targets)
+        if wait() != 0:
+            raise RuntimeError("tar failed to pack the files of {}".format(self.from_dir))
+        missing = set(dest for dest, decompress in targets.values()) - set(stat["dest"] for stat in stats)
+        if missing:
+            raise ValueError("Cannot find files: {}".format(sorted(missing)))
+        files = []
+        for stat in stats:
+            logger.info("{}: {} bytes in {:.3f} s ({:.1f} MB/s) by {}".format(
+                stat["dest"], stat["bytes"], stat["time"], stat["bytes"] / max(stat["time"], 1e-9) / 1e6,
+                stat["method"]))
+            files.append({"file": os.path.basename(stat["dest"]), "method": stat["method"], "bytes": stat["bytes"],
+                          "time": stat["time"], "rate": stat["bytes"] / max(stat["time"], 1e-9)})
+        return files
+
+    def stage_file(self, src, dest, fname):
+        """
+        Copy or link src to dest according to the staging policy, returns the
+        method that was used.
+        """
+        if self.get("staging", "copy") == "copy" or self.fileclient.ssh is not None:
+            self.fileclient.copy(src, dest)
+            return "copy"
+        return link_or_copy(src, dest, self.is_linkable(fname))
+
+    def is_linkable(self, fname):
+        """
+        True if fname is only read by VASP and may be linked.
+        """
+        return any(fnmatch.fnmatch(fname, p) for p in self.get("link_files", LINKABLE_FILES))
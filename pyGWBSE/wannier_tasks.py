@@ -5,17 +5,19 @@ This module defines tasks for WANNIER90 calculation
 """
 
 import os
+from itertools import islice
 
 import numpy as np
 from atomate.utils.utils import get_logger
 from fireworks import explicit_serialize, FiretaskBase
 from pymatgen.core import Structure
-from pymatgen.io.vasp import Vasprun
 from pymatgen.io.vasp.inputs import Incar, Potcar, PotcarSingle
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.symmetry.bandstructure import HighSymmKpath
 
+from pyGWBSE.compress import zopen
 from pyGWBSE.inputset import CreateInputs
+from pyGWBSE.readers import LazyVasprun, find_file, read_band_properties, read_wannier_bands, read_wannier_xtics
 
 logger = get_logger(__name__)
 
@@ -40,10 +42,10 @@ class WriteWannierInputForGW(FiretaskBase):
         reciprocal_density = self["reciprocal_density"]
         prev_incar = Incar.from_file(f_incar)
         wann_inp = str(os.getcwd()) + '/wannier90.win'
-        vasprunfile = str(os.getcwd()) + '/vasprun.xml'
+        vasprunfile = find_file(os.getcwd(), 'vasprun.xml', required=True)
         poscarfile = str(os.getcwd()) + '/POSCAR'
         potcarfile = str(os.getcwd()) + '/POTCAR'
-        vasprun = Vasprun(vasprunfile)
+        vasprun = LazyVasprun(vasprunfile, profile="incar")
         incar = vasprun.incar
         nbands = incar["NBANDS"]
         elements = read_potcar(potcarfile, poscarfile)
@@ -81,10 +83,10 @@ class WriteWannierInputForDFT(FiretaskBase):
         write_hr = self["write_hr"]
         prev_incar = Incar.from_file(f_incar)
         wann_inp = str(os.getcwd()) + '/wannier90.win'
-        vasprunfile = str(os.getcwd()) + '/vasprun.xml'
+        vasprunfile = find_file(os.getcwd(), 'vasprun.xml', required=True)
         poscarfile = str(os.getcwd()) + '/POSCAR'
         potcarfile = str(os.getcwd()) + '/POTCAR'
-        vasprun = Vasprun(vasprunfile)
+        vasprun = LazyVasprun(vasprunfile, profile="incar")
         incar = vasprun.incar
         nbands = incar["NBANDS"]
         elements = read_potcar(potcarfile, poscarfile)
@@ -111,20 +113,14 @@ class CopyKptsWan2vasp(FiretaskBase):
         """
         Your Comments Here
         """
-        f_wannkpt = str(os.getcwd()) + '/wannier90_band.kpt'
+        f_wannkpt = find_file(os.getcwd(), 'wannier90_band.kpt', required=True)
         f_vaspkpt = str(os.getcwd()) + '/KPOINTS'
-        f = open(f_wannkpt)
-        contents = f.readlines()
-        f.close()
-        lines = str.split(contents[0])
-        nkpts = eval(lines[0])
-        f = open(f_vaspkpt, 'w')
-        f.write('kpoints file generated from wannier90_band.kpt' + '\n')
-        f.write(str(nkpts) + '\n')
-        f.write('Reciprocal' + '\n')
-        for ik in range(nkpts):
-            f.write(contents[ik + 1])
-        f.close()
+        with zopen(f_wannkpt, 'rt') as f_in, open(f_vaspkpt, 'w') as f:
+            nkpts = int(f_in.readline().split()[0])
+            f.write('kpoints file generated from wannier90_band.kpt' + '\n')
+            f.write(str(nkpts) + '\n')
+            f.write('Reciprocal' + '\n')
+            f.writelines(islice(f_in, nkpts))
 
 
 def write_wannier_input(numwan, nbands, labels, kpts, wann_inp, elements,write_hr):
@@ -221,75 +217,34 @@ def read_vbm(fname):
     """
     Your Comments Here
     """
-    vasprun = Vasprun(fname, parse_potcar_file=False)
-    gap, cbm, vbm, is_direct = vasprun.eigenvalue_band_properties
+    eigenvalues, (gap, cbm, vbm, is_direct) = read_band_properties(os.path.dirname(os.path.abspath(fname)),
+                                                                   vasprun_fname=fname)
     return gap, vbm
 
 
 def read_wannier(fname_band, fname_kpt, vbm):
     """
-    Your Comments Here
+    Read the Wannier90 band structure, energies are relative to vbm.
     """
-    f = open(fname_band)
-    contents = f.readlines()
-    f.close()
-
-    kvals = []
-    evals = []
-
-    for content in contents:
-        lines = str.split(content)
-        if len(lines) != 0:
-            kvals.append(eval(lines[0]))
-            evals.append(eval(lines[1]))
-    with open(fname_kpt) as f:
-        first_line = f.readline()
-    nkpt = eval(str.split(first_line)[0])
-    nband = int(len(evals) / nkpt)
-    kpts_flat = np.array(kvals)
-    eigs_flat = np.array(evals) - vbm
-    kpts = kpts_flat.reshape(nband, nkpt)
-    eigs = eigs_flat.reshape(nband, nkpt)
-
-    return kpts, eigs
+    kpts, eigs = read_wannier_bands(fname_band, fname_kpt)
+    return kpts, eigs - vbm
 
 
 def read_vasp(fname, vbm):
     """
     Your Comments Here
     """
-    vasprun = Vasprun(fname)
-    eigs = vasprun.eigenvalues
-    nkpt = len(vasprun.actual_kpoints)
+    vasprun = LazyVasprun(fname, profile="read_vasp")
+    eigs = vasprun.eigenvalue_set
     kptvasp = vasprun.actual_kpoints
-    out = []
-    for spin, d in eigs.items():
-        for k, val in enumerate(d):
-            for n, eigenval in enumerate(val):
-                out.append(eigenval[0] - vbm)
-    nbands = int(len(out) / nkpt)
-    eigvasp = np.reshape(out, (nkpt, nbands))
+    # (nkpt, nspin * nband): the bands of all the spins at each k-point
+    eigvasp = eigs.energies.transpose(1, 0, 2).reshape(eigs.nkpt, -1) - vbm
 
     return kptvasp, eigvasp
 
 
 def read_special_kpts(fname):
-    """                                                                         
-    Your Comments Here                                                          
     """
-    f = open(fname)
-    contents = f.readlines()
-    f.close()
-    spkptl = []
-    spkptc = []
-    for content in contents:
-        if 'set xtics' in content:
-            lines = str.split(content,sep='"')
-            for n, words in enumerate(lines):
-                if n!=0 and n%2!=0:
-                    spkptl.append(words)
-                elif n!=0:
-                    spkptc.append(eval(words[:9]))
-
-    return spkptl,spkptc
-
+    Labels and positions of the special k-points from wannier90_band.gnu.
+    """
+    return read_wannier_xtics(fname)
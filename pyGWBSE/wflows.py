@@ -5,17 +5,20 @@
 Defines standardized Fireworks that can be chained easily to perform various
 sequences of VASP calculations.
 """
+import uuid
+
 import numpy as np
 from atomate.common.firetasks.glue_tasks import PassCalcLocs
 from atomate.vasp.firetasks.write_inputs import WriteVaspFromIOSet
-from fireworks import Firework, Tracker
+from fireworks import Firework, Tracker, Workflow
 
 
 from pyGWBSE.inputset import CreateInputs
-from pyGWBSE.out2db import gw2db, bse2db, emc2db, eps2db, Wannier2DB, rpa2db
-from pyGWBSE.run_calc import Run_Vasp, Run_Sumo, Run_Wannier
+from pyGWBSE.out2db import gw2db, bse2db, rpa2db, emc2db, eps2db, scf2db, Wannier2DB, FlushJournal
+from pyGWBSE.run_calc import Run_Vasp, Run_Sumo, Run_Wannier, CleanScratch
 from pyGWBSE.tasks import CopyOutputFiles, CheckBeConv, StopIfConverged, PasscalClocsCond, WriteBSEInput, \
-                            WriteGWInput, MakeWFilesList, SaveNbandsov, SaveConvParams
+                            WriteGWInput, MakeWFilesList, SaveNbandsov, SaveConvParams, CompressOutputs, \
+                            PrefetchFiles
 from pyGWBSE.wannier_tasks import WriteWannierInputForDFT, WriteWannierInputForGW, CopyKptsWan2vasp
 
 
@@ -23,7 +26,7 @@ class ScfFW(Firework):
     def __init__(self, mat_name=None, structure=None, nbands=None, kpar=None, reciprocal_density=None,
                  vasp_input_set=None, vasp_input_params=None, two_dim=False,
                  vasp_cmd="vasp", prev_calc_loc=True, prev_calc_dir=None, db_file=None, wannier_fw=None,
-                 vasptodb_kwargs={}, **kwargs):
+                 vasptodb_kwargs={}, projection_groups=None, full_projections=False, **kwargs):
         """
         Your Comments Here
         """
@@ -36,8 +39,9 @@ class ScfFW(Firework):
                                     vasp_input_set=vasp_input_set,
                                     vasp_input_params=vasp_input_params))
         t.append(Run_Vasp(vasp_cmd=vasp_cmd))
-        t.append(eps2db(structure=structure, mat_name=mat_name, db_file=db_file, defuse_unsuccessful=False))
-        t.append(rpa2db(structure=structure, mat_name=mat_name, task_label=name, db_file=db_file, defuse_unsuccessful=False))
+        t.append(scf2db(structure=structure, mat_name=mat_name, task_label=name, db_file=db_file,
+                        projection_groups=projection_groups, full_projections=full_projections,
+                        defuse_unsuccessful=False))
         t.append(PassCalcLocs(name=name))
         super(ScfFW, self).__init__(t, name=fw_name, **kwargs)
 
@@ -47,7 +51,8 @@ class convFW(Firework):
     def __init__(self, mat_name=None, structure=None, tolerence=None, no_conv=None, nbands=None,
                  nbgwfactor=None, encutgw=None, nomegagw=None, convsteps=None, conviter=None, two_dim=False,
                  kpar=None, nbandsgw=None, reciprocal_density=None, vasp_input_set=None, vasp_input_params=None,
-                 vasp_cmd="vasp", prev_calc_loc=True, prev_calc_dir=None, db_file=None, vasptodb_kwargs={}, parents=None, **kwargs):
+                 vasp_cmd="vasp", prev_calc_loc=True, prev_calc_dir=None, db_file=None, vasptodb_kwargs={}, parents=None,
+                 prefetch_consumers=1, **kwargs):
         t = []
         name = "CONV"
         fw_name = "{}-{}".format(mat_name, name)
@@ -103,6 +108,9 @@ class convFW(Firework):
             t.append(SaveConvParams(nbands=nbands, encutgw=encutgw, nomegagw=nomegagw))
             t.append(CheckBeConv(niter=niter, tolerence=tolerence, no_conv=no_conv))
             t.append(PasscalClocsCond(name=name))
+            # stage the inputs of GwFW while the results are stored
+            t.append(PrefetchFiles(files=['WAVECAR', 'WAVEDER'], when_converged=niter < conviter,
+                                   consumers=prefetch_consumers))
             if no_conv==False:
                 t.append(gw2db(structure=structure, mat_name=mat_name, task_label=task_label, db_file=db_file, defuse_unsuccessful=False))
             t.append(StopIfConverged())
@@ -114,7 +122,7 @@ class GwFW(Firework):
     def __init__(self, mat_name=None, structure=None, tolerence=None, no_conv=None, reciprocal_density=None,
                  vasp_input_set=None, vasp_input_params=None, nbandso=None, nbandsv=None, nbandsgw=None,
                  vasp_cmd="vasp", prev_calc_loc=True, prev_calc_dir=None, db_file=None, wannier_fw=None, two_dim=False,
-                 vasptodb_kwargs={}, job_tag=None, parents=None, **kwargs):
+                 vasptodb_kwargs={}, job_tag=None, parents=None, prefetch_consumers=1, **kwargs):
         """
         Your Comments Here
         """
@@ -129,6 +137,9 @@ class GwFW(Firework):
                 t.append(CopyOutputFiles(additional_files=files2copy, calc_loc=prev_calc_loc, contcar_to_poscar=True))
         t.append(WriteGWInput(structure=structure, reciprocal_density=reciprocal_density, nbandsgw=nbandsgw,
                                 wannier_fw=wannier_fw, two_dim=two_dim))
+        prefetch_files = ['WAVECAR', 'WAVEDER', 'W*.tmp']
+        if wannier_fw:
+            prefetch_files += ['wannier90.win', 'wannier90.mmn', 'wannier90.amn', 'wannier90.eig']
         for niter in range(1, 10):
             task_label = 'scGW_Iteration: ' + str(niter)
             if wannier_fw:
@@ -137,6 +148,8 @@ class GwFW(Firework):
             t.append(CheckBeConv(niter=niter, tolerence=tolerence, no_conv=no_conv))
             t.append(PasscalClocsCond(name=name))
             t.append(MakeWFilesList())
+            # stage the inputs of BseFW (and WannierFW) while the results are stored
+            t.append(PrefetchFiles(files=prefetch_files, when_converged=niter < 9, consumers=prefetch_consumers))
             t.append(
                 gw2db(structure=structure, mat_name=mat_name, task_label=task_label, job_tag=job_tag, db_file=db_file,
                       defuse_unsuccessful=False))
@@ -150,7 +163,7 @@ class BseFW(Firework):
     def __init__(self, mat_name=None, structure=None, reciprocal_density=None, vasp_input_set=None,
                  vasp_input_params=None, enwinbse=None, two_dim=False,
                  vasp_cmd="vasp", prev_calc_loc=True, prev_calc_dir=None, db_file=None, vasptodb_kwargs={},
-                 job_tag=None, parents=None, **kwargs):
+                 job_tag=None, max_transitions=None, transition_energy_cutoff=None, parents=None, **kwargs):
         """
         Your Comments Here
         """
@@ -167,6 +180,7 @@ class BseFW(Firework):
         t.append(WriteBSEInput(structure=structure, reciprocal_density=reciprocal_density, two_dim=two_dim))
         t.append(Run_Vasp(vasp_cmd=vasp_cmd))
         t.append(bse2db(structure=structure, mat_name=mat_name, task_label=name, job_tag=job_tag, db_file=db_file,
+                        max_transitions=max_transitions, transition_energy_cutoff=transition_energy_cutoff,
                         defuse_unsuccessful=False))
         tracker = Tracker('vasp.log', nlines=100)
 
@@ -250,3 +264,107 @@ class WannierFW(Firework):
         tracker = Tracker('wannier90.wout', nlines=100)
 
         super(WannierFW, self).__init__(t, parents=parents, name=fw_name, spec={"_trackers": [tracker]}, **kwargs)
+
+
+def use_scratch(wf, scratch_dir=">>scratch_dir<<"):
+    """
+    Run VASP in node-local scratch directories (see Run_Vasp) in the Fireworks of
+    the workflow wf. The scratch files that are copied back to the launch
+    directory of a Firework are those that its children copy (their
+    CopyOutputFiles), and the W*.tmp files listed by MakeWFilesList. The
+    scratch directory is removed at the end of the Firework (CleanScratch, or
+    StopIfConverged when it stops a converged Firework).
+    """
+    for fw in wf.fws:
+        keep_files = set()
+        for child_id in wf.links[fw.fw_id]:
+            child = wf.id_fw[child_id]
+            for task in child.tasks:
+                if isinstance(task, CopyOutputFiles):
+                    keep_files.update(task.get_files_to_copy(child.spec) or ["*"])
+        if any(isinstance(task, MakeWFilesList) for task in fw.tasks):
+            keep_files.add("W*.tmp")
+        for task in fw.tasks:
+            if isinstance(task, Run_Vasp):
+                task["scratch_dir"] = scratch_dir
+                task["keep_files"] = sorted(keep_files)
+        if any(isinstance(task, Run_Vasp) for task in fw.tasks):
+            for task in fw.tasks:
+                if isinstance(task, StopIfConverged):
+                    task["scratch_dir"] = scratch_dir
+            fw.tasks.append(CleanScratch(scratch_dir=scratch_dir))
+    return wf
+
+
+def use_staging(wf, staging="cache", **kwargs):
+    """
+    Set the staging policy of the CopyOutputFiles of the workflow wf: "copy"
+    (the default of CopyOutputFiles), "link" or "cache" (see CopyOutputFiles),
+    with the other staging parameters in kwargs, e.g. link_files or
+    staging_cache.
+    """
+    for fw in wf.fws:
+        for task in fw.tasks:
+            if isinstance(task, CopyOutputFiles):
+                task["staging"] = staging
+                task.update(kwargs)
+    return wf
+
+
+def add_compression(fw, compress_outputs=None):
+    """
+    Compress the outputs of the Firework fw once it is finished, see
+    CompressOutputs for the parameters in compress_outputs. The Fireworks that
+    stop early when they are converged compress their outputs before stopping.
+    """
+    compress_outputs = dict(compress_outputs or {})
+    for task in fw.tasks:
+        if isinstance(task, StopIfConverged):
+            task["compress_outputs"] = compress_outputs
+    fw.tasks.append(CompressOutputs(**compress_outputs))
+    return fw
+
+
+def use_journal(wf, journal=">>db_journal<<", fw_name="flush_journal"):
+    """
+    Write the results of the workflow wf to result journals instead of the
+    database (see pyGWBSE.journal) and flush them in a last Firework, a child of
+    every Firework of wf that also runs after fizzled parents. FireWorks leaves
+    the children of a fizzled Firework waiting, so this Firework only runs when
+    the whole workflow finished: when a Firework fizzles, the journals must be
+    flushed by the flusher process, e.g.
+
+        python -m pyGWBSE.journal <journal directory or launch directories>
+    """
+    for fw in wf.fws:
+        for task in fw.tasks:
+            if isinstance(task, (gw2db, bse2db, rpa2db, emc2db, eps2db, scf2db, Wannier2DB)):
+                task["journal"] = journal
+    flush_fw = Firework(FlushJournal(journal=journal), name=fw_name, spec={"_allow_fizzled_parents": True})
+    wf.append_wf(Workflow([flush_fw]), [fw.fw_id for fw in wf.fws])
+    return wf
+
+
+def use_array_storage(wf, array_storage=True):
+    """
+    Store the large arrays of the results of the workflow wf as compressed binary
+    arrays (see pyGWBSE.arrays) instead of nested lists; array_storage is True
+    or the arguments of pack_arrays, e.g. {"dtype": "float32"}.
+    """
+    for fw in wf.fws:
+        for task in fw.tasks:
+            if isinstance(task, (gw2db, bse2db, rpa2db, eps2db, scf2db, Wannier2DB)):
+                task["array_storage"] = array_storage
+    return wf
+
+
+def add_workflow_id(wf, workflow_id=None):
+    """
+    Set the id of the workflow wf ("wf_uuid" of the spec of its Fireworks), which
+    the out2db tasks store in the indexed workflow_id of their results, e.g. to
+    find the results of one submission.
+    """
+    workflow_id = workflow_id or str(uuid.uuid4())
+    for fw in wf.fws:
+        fw.spec["wf_uuid"] = workflow_id
+    return wf
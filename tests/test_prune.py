@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import os
+
+from fireworks import Firework, Workflow
+from fireworks.core.firework import Launch
+
+from pyGWBSE.prune import find_prunable_files
+from pyGWBSE.tasks import CopyOutputFiles
+
+
+def make_fw(fw_id, name, launch_dir, state="COMPLETED"):
+    tasks = [CopyOutputFiles(additional_files=["WAVEDER", "WAVECAR"])]
+    launches = [Launch(state=state, launch_dir=str(launch_dir))] if launch_dir else []
+    return Firework(tasks, name=name, fw_id=fw_id, state=state, launches=launches)
+
+
+def make_wf(tmp_path, bse_state):
+    conv, gw, bse = tmp_path / "conv", tmp_path / "gw", tmp_path / "bse"
+    for d in (conv, gw, bse):
+        d.mkdir()
+    (conv / "WAVEDER").write_bytes(b"w" * 100)
+    (conv / "WAVECAR").write_bytes(b"c" * 50)
+    os.symlink(conv / "WAVEDER", gw / "WAVEDER")
+    fws = [make_fw(1, "CONV", conv), make_fw(2, "GW", gw),
+           make_fw(3, "BSE", bse if bse_state == "COMPLETED" else None, bse_state)]
+    return Workflow(fws, {1: [2], 2: [3]})
+
+
+def test_linked_file_kept_for_transitive_consumer(tmp_path):
+    wf = make_wf(tmp_path, "READY")
+    paths = {f["path"] for f in find_prunable_files(wf)}
+    assert str(tmp_path / "conv" / "WAVEDER") not in paths
+    assert str(tmp_path / "gw" / "WAVEDER") not in paths
+
+
+def test_bytes_counted_once_per_inode(tmp_path):
+    wf = make_wf(tmp_path, "COMPLETED")
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    os.link(tmp_path / "conv" / "WAVECAR", cache / "WAVECAR")
+    files = {f["path"]: f for f in find_prunable_files(wf)}
+    assert files[str(tmp_path / "conv" / "WAVEDER")]["bytes"] == 100
+    assert files[str(tmp_path / "gw" / "WAVEDER")]["bytes"] == 0
+    assert files[str(tmp_path / "gw" / "WAVEDER")]["target"] == str(tmp_path / "conv" / "WAVEDER")
+    # still linked from the cache, nothing is reclaimed
+    assert files[str(tmp_path / "conv" / "WAVECAR")]["bytes"] == 0
@@ -0,0 +1,41 @@
+# coding: utf-8
+
+import pytest
+
+from pyGWBSE.readers import LazyVasprun
+
+LFE_COMMENT = "INVERSE MACROSCOPIC DIELECTRIC TENSOR (including local field effects in RPA (Hartree))"
+
+
+def dielectric_function(energy, comment=None):
+    attrib = ' comment="{}"'.format(comment) if comment is not None else ""
+    rows = "<r> {} 1 2 3 4 5 6 </r>".format(energy)
+    return ("<dielectricfunction{}><imag><array><set>{}</set></array></imag>"
+            "<real><array><set>{}</set></array></real></dielectricfunction>").format(attrib, rows, rows)
+
+
+def write_vasprun(path, functions):
+    path.write_text("<?xml version=\"1.0\"?><modeling><calculation>{}</calculation></modeling>".format(
+        "".join(functions)))
+    return str(path)
+
+
+@pytest.mark.parametrize("comments, density, velocity", [
+    ([None, None], 1.0, 2.0),
+    ([LFE_COMMENT, "current-current response function"], 1.0, None),
+    (["density-density", "current-current"], 1.0, 2.0),
+    (["current-current", "density-density"], 2.0, 1.0),
+])
+def test_dielectric_comments(tmp_path, comments, density, velocity):
+    functions = [dielectric_function(i + 1.0, c) for i, c in enumerate(comments)]
+    vrun = LazyVasprun(write_vasprun(tmp_path / "vasprun.xml", functions), sections=["dielectric"])
+    assert vrun.dielectric[0] == [density]
+    diel = vrun.dielectric_data
+    assert (diel["velocity"][0] == [velocity]) if velocity else "velocity" not in diel
+
+
+def test_other_dielectric(tmp_path):
+    functions = [dielectric_function(1.0, "density-density"), dielectric_function(2.0, "HEAD OF MICROSCOPIC")]
+    vrun = LazyVasprun(write_vasprun(tmp_path / "vasprun.xml", functions), sections=["dielectric"])
+    assert vrun.dielectric[0] == [1.0]
+    assert vrun.other_dielectric["HEAD OF MICROSCOPIC"][0] == [2.0]
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import os
+import shutil
+import sys
+
+from pyGWBSE.run_calc import Run_Vasp, CleanScratch, scratch_name
+
+# stub of VASP: reads WAVECAR, reports it in OUTCAR and rewrites it
+FAKE_VASP = """
+with open("WAVECAR") as f:
+    wavecar = f.read()
+with open("OUTCAR", "w") as f:
+    f.write(wavecar)
+with open("WAVECAR", "w") as f:
+    f.write(wavecar + "+run")
+"""
+
+
+def run_vasp(launch_dir, scratch_root, vasp_cmd):
+    cwd = os.getcwd()
+    os.chdir(launch_dir)
+    try:
+        Run_Vasp(vasp_cmd=vasp_cmd, scratch_dir=scratch_root).run_task({})
+    finally:
+        os.chdir(cwd)
+    with open(os.path.join(launch_dir, "OUTCAR")) as f:
+        return f.read()
+
+
+def test_scratch_restaged_wavecar(tmp_path):
+    src, launch, scratch_root = tmp_path / "scf", tmp_path / "launch", tmp_path / "scratch"
+    src.mkdir()
+    launch.mkdir()
+    (src / "WAVECAR").write_text("scf")
+    os.utime(src / "WAVECAR", (1e9, 1e9))
+    (tmp_path / "vasp.py").write_text(FAKE_VASP)
+    vasp_cmd = "{} {}".format(sys.executable, tmp_path / "vasp.py")
+
+    shutil.copy2(src / "WAVECAR", launch / "WAVECAR")
+    assert run_vasp(launch, scratch_root, vasp_cmd) == "scf"
+    # WAVECAR is not copied back, the next run continues from the scratch version
+    assert (launch / "WAVECAR").read_text() == "scf"
+    assert run_vasp(launch, scratch_root, vasp_cmd) == "scf+run"
+
+    # staged again with its old modification time, like CopyOutputFiles does
+    shutil.copy2(src / "WAVECAR", launch / "WAVECAR")
+    assert run_vasp(launch, scratch_root, vasp_cmd) == "scf"
+
+    scratch = scratch_root / scratch_name(str(launch))
+    assert scratch.is_dir()
+    cwd = os.getcwd()
+    os.chdir(launch)
+    try:
+        CleanScratch(scratch_dir=str(scratch_root)).run_task({})
+    finally:
+        os.chdir(cwd)
+    assert not scratch.exists()
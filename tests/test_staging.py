@@ -0,0 +1,119 @@
+# coding: utf-8
+
+import gzip
+import os
+import shutil
+import stat
+import threading
+import types
+
+import pytest
+
+from pyGWBSE.staging import CONSUMERS_FILE, claim_prefetched, open_tar_stream, prefetch_files, release_prefetched, \
+    unpack_tar_stream
+from pyGWBSE.tasks import CopyOutputFiles
+
+# name: (content, mode, mtime)
+FILES = {"INCAR": (b"ALGO = Exact\n", 0o644, 1.0e9),
+         "WAVECAR": (os.urandom(3 << 20), 0o600, 1.1e9),
+         "run.sh": (b"#!/bin/sh\n", 0o755, 1.2e9)}
+
+
+def make_source(src):
+    src.mkdir()
+    for name, (data, mode, mtime) in FILES.items():
+        (src / name).write_bytes(data)
+        os.chmod(src / name, mode)
+        os.utime(src / name, (mtime, mtime))
+    with gzip.open(src / "CHGCAR.gz", "wb") as f:
+        f.write(b"chgcar")
+    os.utime(src / "CHGCAR.gz", (1.3e9, 1.3e9))
+
+
+def assert_copied(dest):
+    for name, (data, mode, mtime) in FILES.items():
+        st = os.stat(dest / name)
+        assert (dest / name).read_bytes() == data
+        assert stat.S_IMODE(st.st_mode) == mode
+        assert st.st_mtime == mtime
+    assert (dest / "CHGCAR").read_bytes() == b"chgcar"
+    assert os.stat(dest / "CHGCAR").st_mtime == 1.3e9
+
+
+def test_tar_stream_loopback(tmp_path):
+    src, dest = tmp_path / "src", tmp_path / "dest"
+    make_source(src)
+    dest.mkdir()
+    targets = {name: (str(dest / name), False) for name in FILES}
+    targets["CHGCAR.gz"] = (str(dest / "CHGCAR"), True)
+    stream, wait = open_tar_stream(str(src), sorted(targets))
+    stats = unpack_tar_stream(stream, targets)
+    assert wait() == 0
+    assert sorted(s["dest"] for s in stats) == sorted(d for d, decompress in targets.values())
+    assert_copied(dest)
+
+
+def test_bulk_copy(tmp_path):
+    src, dest = tmp_path / "src", tmp_path / "dest"
+    make_source(src)
+    dest.mkdir()
+    task = CopyOutputFiles()
+    task.from_dir = str(src)
+    task.fileclient = types.SimpleNamespace(ssh=None)
+    jobs = [(name, str(src / name), str(dest / name), "") for name in FILES]
+    jobs.append(("CHGCAR", str(src / "CHGCAR.gz"), str(dest / "CHGCAR"), ".gz"))
+    files = task.bulk_copy(jobs)
+    assert sorted(f["file"] for f in files) == sorted(list(FILES) + ["CHGCAR"])
+    assert_copied(dest)
+
+
+def test_prefetch_daemon_threads(tmp_path):
+    src, stage = tmp_path / "src", tmp_path / "stage"
+    make_source(src)
+    futures = prefetch_files(str(src), sorted(FILES), str(stage), workers=2)
+    assert all(t.daemon for t in threading.enumerate() if t.name.startswith("prefetch-"))
+    for future in futures:
+        future.result(timeout=30)
+    assert claim_prefetched(str(stage), str(src / "WAVECAR"), str(tmp_path / "WAVECAR")) == "prefetch:move"
+    assert (tmp_path / "WAVECAR").read_bytes() == FILES["WAVECAR"][0]
+
+
+def test_prefetch_failure_leaves_no_claim(tmp_path, monkeypatch):
+    src, stage = tmp_path / "src", tmp_path / "stage"
+    make_source(src)
+
+    def failing_copy(src_path, dest_path):
+        with open(dest_path, "wb") as f:
+            f.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(shutil, "copyfile", failing_copy)
+    (future,) = prefetch_files(str(src), ["WAVECAR"], str(stage))
+    with pytest.raises(OSError):
+        future.result(timeout=30)
+    assert os.listdir(stage) == [CONSUMERS_FILE]
+    assert claim_prefetched(str(stage), str(src / "WAVECAR"), str(tmp_path / "WAVECAR")) is None
+
+
+def test_prefetch_released_by_last_consumer(tmp_path):
+    src, stage = tmp_path / "src", tmp_path / "stage"
+    make_source(src)
+    (src / "WAVEDER").write_bytes(b"waveder")
+    # left by a prefetch killed with its process
+    stage.mkdir()
+    (stage / "WAVEDER.part").write_bytes(b"wave")
+    futures = prefetch_files(str(src), ["WAVECAR", "WAVEDER"], str(stage), consumers=2)
+    assert not (stage / "WAVEDER.part").exists()
+    for future in futures:
+        future.result(timeout=30)
+    for run in ("bse", "wannier"):
+        (tmp_path / run).mkdir()
+        dest = tmp_path / run / "WAVEDER"
+        assert claim_prefetched(str(stage), str(src / "WAVEDER"), str(dest), linkable=True) == "prefetch:hardlink"
+    assert claim_prefetched(str(stage), str(src / "WAVECAR"), str(tmp_path / "bse" / "WAVECAR")) == "prefetch:move"
+    assert not release_prefetched(str(stage))
+    assert stage.exists()
+    assert release_prefetched(str(stage))
+    assert not stage.exists()
+    assert os.stat(tmp_path / "bse" / "WAVEDER").st_nlink == 2
+    assert not release_prefetched(str(stage))